@@ -5,23 +5,150 @@ import time
 import hashlib
 from datetime import datetime, timedelta
 import os
+import socket
+import threading
+from collections import Counter
 import psycopg2
+from psycopg2.extras import execute_values
+from codec import ValueCodec
+
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:
+    # NEGATIVE_CACHE_BLOOM=true の時だけ必要
+    ScalableBloomFilter = None
+
+CACHE_TTL = 300
+
+# 書き込みモード: write_through (同期DB書き込み) / write_behind (非同期バッチ書き込み)
+WRITE_MODE = os.environ.get("WRITE_MODE", "write_through")
+WRITE_BEHIND_STREAM = "write_behind:cache_data"
+WRITE_BEHIND_GROUP = "write_behind_flusher"
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 500))
+WRITE_BEHIND_FLUSH_INTERVAL_MS = int(
+    os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL_MS", 200)
+)
+# 他のフラッシャが抱えたまま止まったエントリを引き取る間隔とアイドル時間
+WRITE_BEHIND_CLAIM_INTERVAL = int(os.environ.get("WRITE_BEHIND_CLAIM_INTERVAL", 30))
+WRITE_BEHIND_CLAIM_MIN_IDLE_MS = int(
+    os.environ.get("WRITE_BEHIND_CLAIM_MIN_IDLE_MS", 30000)
+)
+# 1行ずつでも書けない行と、配信回数がこれを超えたエントリはデッドレターへ移す
+WRITE_BEHIND_MAX_DELIVERIES = int(os.environ.get("WRITE_BEHIND_MAX_DELIVERIES", 5))
+WRITE_BEHIND_DEAD_LETTER_STREAM = "write_behind:cache_data:dead"
+# 接続断などDB側の一時的な障害。行のせいではないのでバッチごと再試行する
+DB_RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# DBに繋ぎ直せない間の再試行間隔の上限 (秒)
+DB_RECONNECT_MAX_BACKOFF = 30
+
+# キャッシュ値のエンコード設定 (serializer: json/orjson/msgpack, compression: none/zlib/zstd/lz4)
+CACHE_SERIALIZER = os.environ.get("CACHE_SERIALIZER", "json")
+CACHE_COMPRESSION = os.environ.get("CACHE_COMPRESSION", "zlib")
+CACHE_COMPRESSION_THRESHOLD = int(os.environ.get("CACHE_COMPRESSION_THRESHOLD", 1024))
+
+# ネガティブキャッシュ: DBに存在しないIDを短いTTLの墓石(tombstone)として記録する
+# 墓石はコーデックのヘッダ (バージョン1) とも旧形式のJSONとも衝突しない1バイト
+TOMBSTONE = b"\x00"
+NEGATIVE_CACHE_TTL = int(os.environ.get("NEGATIVE_CACHE_TTL", 30))
+# 存在するIDのブルームフィルタ (このプロセスが唯一の書き込み元である前提で有効化する)
+NEGATIVE_CACHE_BLOOM = os.environ.get("NEGATIVE_CACHE_BLOOM", "false").lower() == "true"
+BLOOM_INITIAL_CAPACITY = int(os.environ.get("BLOOM_INITIAL_CAPACITY", 100000))
+BLOOM_ERROR_RATE = float(os.environ.get("BLOOM_ERROR_RATE", 0.001))
+
+# アクセスログ: キャッシュヒットしたキーをSorted Setでカウントし、ウォームアップ/リフレッシュの対象を決める
+ACCESS_LOG_KEY = "access_log:cache"
+ACCESS_LOG_MAX_ENTRIES = int(os.environ.get("ACCESS_LOG_MAX_ENTRIES", 10000))
+ACCESS_LOG = os.environ.get("ACCESS_LOG", "false").lower() == "true"
+# ACCESS_LOG_DECAY_INTERVAL 秒ごとにスコアを ACCESS_LOG_DECAY_FACTOR 倍して、過去のアクセスを忘れる
+ACCESS_LOG_DECAY_INTERVAL = int(os.environ.get("ACCESS_LOG_DECAY_INTERVAL", 300))
+ACCESS_LOG_DECAY_FACTOR = float(os.environ.get("ACCESS_LOG_DECAY_FACTOR", 0.5))
+# 減衰を1インターバルに1回 (全プロセスで1つ) に限るためのキー
+ACCESS_LOG_DECAY_LOCK_KEY = f"{ACCESS_LOG_KEY}:decayed"
+# ウォームアップ: source は recent (cache_data の更新日時順) / access_log
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "false").lower() == "true"
+WARMUP_SOURCE = os.environ.get("WARMUP_SOURCE", "recent")
+WARMUP_LIMIT = int(os.environ.get("WARMUP_LIMIT", 1000))
+WARMUP_BATCH_SIZE = int(os.environ.get("WARMUP_BATCH_SIZE", 200))
+# リフレッシュアヘッド: TTL切れの REFRESH_AHEAD_WINDOW 秒前にホットキーを再読み込み
+REFRESH_AHEAD = os.environ.get("REFRESH_AHEAD", "false").lower() == "true"
+REFRESH_AHEAD_INTERVAL = int(os.environ.get("REFRESH_AHEAD_INTERVAL", 10))
+REFRESH_AHEAD_WINDOW = int(os.environ.get("REFRESH_AHEAD_WINDOW", 30))
+REFRESH_AHEAD_TOP_N = int(os.environ.get("REFRESH_AHEAD_TOP_N", 1000))
+
+
+def write_stream_version(msg_id):
+    """Stream ID "<ms>-<seq>" as one increasing integer (seq < 1,000,000 per ms)."""
+    ms, seq = msg_id.split("-")
+    return int(ms) * 1_000_000 + int(seq)
 
 
 class CacheAsideKVS:
-    def __init__(self, redis_host="redis", redis_port=6379, db_host="db", db_port=5432):
+    def __init__(
+        self,
+        redis_host="redis",
+        redis_port=6379,
+        db_host="db",
+        db_port=5432,
+        write_mode=WRITE_MODE,
+        use_bloom=NEGATIVE_CACHE_BLOOM,
+        access_log=ACCESS_LOG,
+        refresh_ahead=REFRESH_AHEAD,
+    ):
+        if write_mode not in ("write_through", "write_behind"):
+            raise ValueError(f"Unknown write mode: {write_mode}")
         self.redis_client = redis.Redis(
             host=redis_host, port=redis_port, decode_responses=True
         )
-        self.db_conn = psycopg2.connect(
-            host=db_host,
-            port=db_port,
+        # キャッシュ値はバイナリで保存するためデコードしないクライアントを使う
+        self.cache_client = redis.Redis(
+            host=redis_host, port=redis_port, decode_responses=False
+        )
+        self.codec = ValueCodec(
+            CACHE_SERIALIZER, CACHE_COMPRESSION, CACHE_COMPRESSION_THRESHOLD
+        )
+        self.db_host = db_host
+        self.db_port = db_port
+        self.db_conn = self._connect_db()
+        self.write_mode = write_mode
+        self.cache_stats = {
+            "hits": 0,
+            "misses": 0,
+            "negative_hits": 0,
+            "bloom_rejections": 0,
+        }
+        self.write_behind_stats = {
+            "flushed_rows": 0,
+            "coalesced": 0,
+            "batches": 0,
+            "row_retries": 0,
+            "dead_lettered": 0,
+        }
+        self.codec_stats = {"encoded_values": 0, "serialized_bytes": 0, "stored_bytes": 0}
+        self.warm_stats = {"warmed": 0, "refreshed": 0, "extended": 0}
+        # リフレッシュアヘッドはアクセスログからホットキーを選ぶ
+        self.access_log = access_log or refresh_ahead
+        # ヒット数はプロセス内で数え、バックグラウンドでまとめてZINCRBYする
+        self.access_counts = Counter()
+        self.access_lock = threading.Lock()
+        self.refresh_ahead = refresh_ahead
+        self._init_db()
+        self.bloom = None
+        self.bloom_lock = threading.Lock()
+        if use_bloom:
+            self._load_bloom()
+        if self.write_mode == "write_behind":
+            self._init_write_behind()
+        if self.access_log:
+            threading.Thread(target=self._access_log_worker, daemon=True).start()
+
+    def _connect_db(self):
+        return psycopg2.connect(
+            host=self.db_host,
+            port=self.db_port,
             database=os.environ.get("POSTGRES_DB", "cache_aside_db"),
             user=os.environ.get("POSTGRES_USER", "postgres"),
             password=os.environ.get("POSTGRES_PASSWORD", "password"),
         )
-        self.cache_stats = {"hits": 0, "misses": 0}
-        self._init_db()
 
     def _init_db(self):
         with self.db_conn.cursor() as cursor:
@@ -34,25 +161,72 @@ class CacheAsideKVS:
                     PRIMARY KEY (entity_type, entity_id)
                 )
             """)
+            # Write-Behindで反映したエントリのバージョン (ストリームID由来、write_stream_version)
+            cursor.execute(
+                "ALTER TABLE cache_data ADD COLUMN IF NOT EXISTS version BIGINT"
+            )
             self.db_conn.commit()
 
+    def _load_bloom(self):
+        if ScalableBloomFilter is None:
+            raise RuntimeError("NEGATIVE_CACHE_BLOOM is enabled but pybloom_live is not installed")
+        # cache_data の全IDをサーバサイドカーソルで少しずつ読み込む
+        bloom = ScalableBloomFilter(
+            initial_capacity=BLOOM_INITIAL_CAPACITY, error_rate=BLOOM_ERROR_RATE
+        )
+        with self.db_conn.cursor(name="bloom_loader") as cursor:
+            cursor.itersize = 10000
+            cursor.execute("SELECT entity_type, entity_id FROM cache_data")
+            for entity_type, entity_id in cursor:
+                bloom.add(f"{entity_type}:{entity_id}")
+        self.db_conn.commit()
+        self.bloom = bloom
+
+    def _bloom_add(self, entity_type, entity_id):
+        if self.bloom is not None:
+            with self.bloom_lock:
+                self.bloom.add(f"{entity_type}:{entity_id}")
+
     def get(self, entity_type, entity_id):
         cache_key = f"cache:{entity_type}:{entity_id}"
 
         # Cache Hit チェック
-        cached_data = self.redis_client.get(cache_key)
+        cached_data = self.cache_client.get(cache_key)
+        if cached_data == TOMBSTONE:
+            # 存在しないことがキャッシュ済み
+            self.cache_stats["negative_hits"] += 1
+            return {
+                "data": None,
+                "source": "negative_cache",
+                "timestamp": datetime.now().isoformat(),
+            }
         if cached_data:
             self.cache_stats["hits"] += 1
+            if self.access_log:
+                with self.access_lock:
+                    self.access_counts[f"{entity_type}:{entity_id}"] += 1
             return {
-                "data": json.loads(cached_data),
+                "data": self.codec.decode(cached_data),
                 "source": "cache",
                 "timestamp": datetime.now().isoformat(),
             }
 
+        # ブルームフィルタが「存在しない」と判定したIDはDBに問い合わせない
+        if self.bloom is not None and f"{entity_type}:{entity_id}" not in self.bloom:
+            self.cache_stats["bloom_rejections"] += 1
+            return {
+                "data": None,
+                "source": "bloom_filter",
+                "timestamp": datetime.now().isoformat(),
+            }
+
         # Cache Miss - DBから取得
         self.cache_stats["misses"] += 1
         db_data = self._db_read(entity_type, entity_id)
         if db_data is None:
+            # 墓石を短いTTLで保存し、同じIDへの繰り返しアクセスをキャッシュで返す
+            # (読み取り中に /set された値を墓石で上書きしないよう、キーが無い時だけ)
+            self.cache_client.set(cache_key, TOMBSTONE, ex=NEGATIVE_CACHE_TTL, nx=True)
             return {
                 "data": None,
                 "source": "database",
@@ -60,7 +234,7 @@ class CacheAsideKVS:
             }
 
         # キャッシュに保存 (TTL: 300秒)
-        self.redis_client.setex(cache_key, 300, json.dumps(db_data))
+        self.cache_client.setex(cache_key, CACHE_TTL, self._encode(db_data))
 
         return {
             "data": db_data,
@@ -69,14 +243,30 @@ class CacheAsideKVS:
         }
 
     def set(self, entity_type, entity_id, data):
-        # Write-Through: DBとキャッシュ両方に書き込み
         cache_key = f"cache:{entity_type}:{entity_id}"
+        self._bloom_add(entity_type, entity_id)
+
+        if self.write_mode == "write_behind":
+            # Write-Behind: キャッシュ更新とバッファ追記を1往復で行い、DB書き込みは非同期
+            with self.cache_client.pipeline() as pipe:
+                pipe.setex(cache_key, CACHE_TTL, self._encode(data))
+                pipe.xadd(
+                    WRITE_BEHIND_STREAM,
+                    {
+                        "entity_type": entity_type,
+                        "entity_id": entity_id,
+                        "data": json.dumps(data),
+                    },
+                )
+                pipe.execute()
+            return {"status": "accepted", "cache_updated": True, "db_write": "deferred"}
 
+        # Write-Through: DBとキャッシュ両方に書き込み
         # DB書き込み
         self._db_write(entity_type, entity_id, data)
 
         # キャッシュ更新
-        self.redis_client.setex(cache_key, 300, json.dumps(data))
+        self.cache_client.setex(cache_key, CACHE_TTL, self._encode(data))
 
         return {"status": "success", "cache_updated": True}
 
@@ -98,11 +288,388 @@ class CacheAsideKVS:
         total = self.cache_stats["hits"] + self.cache_stats["misses"]
         hit_ratio = (self.cache_stats["hits"] / total * 100) if total > 0 else 0
 
-        return {
+        stats = {
             "cache_hits": self.cache_stats["hits"],
             "cache_misses": self.cache_stats["misses"],
+            "negative_hits": self.cache_stats["negative_hits"],
+            "bloom_rejections": self.cache_stats["bloom_rejections"],
+            "bloom_enabled": self.bloom is not None,
+            "warming": {
+                **self.warm_stats,
+                "access_log": self.access_log,
+                "refresh_ahead": self.refresh_ahead,
+            },
             "hit_ratio": round(hit_ratio, 2),
             "cache_size": self.redis_client.dbsize(),
+            "write_mode": self.write_mode,
+            "codec": {
+                "serializer": self.codec.serializer,
+                "compression": self.codec.compression,
+                "compression_threshold": self.codec.threshold,
+                **self.codec_stats,
+                "bytes_saved": self.codec_stats["serialized_bytes"]
+                - self.codec_stats["stored_bytes"],
+            },
+        }
+        if self.write_mode == "write_behind":
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.xlen(WRITE_BEHIND_STREAM)
+                pipe.xlen(WRITE_BEHIND_DEAD_LETTER_STREAM)
+                buffered, dead_letters = pipe.execute()
+            stats["write_behind"] = {
+                **self.write_behind_stats,
+                "buffered": buffered,
+                "dead_letters": dead_letters,
+            }
+        return stats
+
+    def _encode(self, value):
+        blob, serialized_size = self.codec.encode(value)
+        self.codec_stats["encoded_values"] += 1
+        self.codec_stats["serialized_bytes"] += serialized_size
+        self.codec_stats["stored_bytes"] += len(blob)
+        return blob
+
+    def _init_write_behind(self):
+        # バッファ用ストリームとコンシューマグループを作成
+        try:
+            self.redis_client.xgroup_create(
+                WRITE_BEHIND_STREAM, WRITE_BEHIND_GROUP, id="0", mkstream=True
+            )
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        threading.Thread(target=self._write_behind_worker, daemon=True).start()
+
+    def _write_behind_worker(self):
+        """バッファを読み出し、同一キーへの書き込みをまとめてDBへ一括反映"""
+        # フラッシャ専用のDB接続 (リクエストスレッドの接続とコミットを混在させない)
+        conn = self._connect_db()
+        consumer = f"flusher-{socket.gethostname()}"
+        next_claim = 0.0
+        messages = []
+        # 起動時は未ACKのエントリ (前回クラッシュ時の書き残し) から再処理する
+        last_id = "0"
+        while True:
+            try:
+                # 止まったフラッシャのエントリは起動時だけでなく定期的に引き取る
+                if time.monotonic() >= next_claim:
+                    if self._claim_stale_write_behind(consumer):
+                        last_id = "0"
+                    next_claim = time.monotonic() + WRITE_BEHIND_CLAIM_INTERVAL
+                if not messages:
+                    entries = self.redis_client.xreadgroup(
+                        WRITE_BEHIND_GROUP,
+                        consumer,
+                        {WRITE_BEHIND_STREAM: last_id},
+                        count=WRITE_BEHIND_BATCH_SIZE,
+                        block=WRITE_BEHIND_FLUSH_INTERVAL_MS,
+                    )
+                    messages = entries[0][1] if entries else []
+                    if not messages:
+                        # 未ACK分を処理し終えたら新着のみを読む
+                        last_id = ">"
+                        continue
+                self._flush_write_behind(conn, consumer, messages)
+                messages = []
+            except (redis.RedisError, psycopg2.Error) as e:
+                print(f"Write-behind flush failed: {e}")
+                conn = self._recover_db(conn)
+                # 失敗したバッチは読み直さずにそのまま再試行する
+                # (読み直すと配信回数が増え、DB停止中にデッドレターへ送られてしまう)
+                time.sleep(1)
+
+    def _recover_db(self, conn):
+        """エラー後の接続をロールバックし、切れていれば繋ぎ直す (DBが戻るまでバックオフして再試行)"""
+        delay = 1
+        while True:
+            try:
+                if conn.closed:
+                    conn = self._connect_db()
+                else:
+                    conn.rollback()
+                return conn
+            except psycopg2.Error as e:
+                print(f"DB reconnect failed: {e}")
+                # ロールバックできない接続は閉じて次は繋ぎ直す
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+                time.sleep(delay)
+                delay = min(delay * 2, DB_RECONNECT_MAX_BACKOFF)
+
+    def _claim_stale_write_behind(self, consumer):
+        """停止した他のフラッシャが抱えたままの未ACKエントリを引き取り、件数を返す
+
+        自分の処理中のバッチ (DB停止中に再試行しているものなど) は引き取らない。
+        引き取ると配信回数が増え、障害が続くだけでデッドレターへ送られてしまう。
+        """
+        claimed = 0
+        start = "-"
+        while True:
+            entries = self.redis_client.xpending_range(
+                WRITE_BEHIND_STREAM,
+                WRITE_BEHIND_GROUP,
+                min=start,
+                max="+",
+                count=WRITE_BEHIND_BATCH_SIZE,
+                idle=WRITE_BEHIND_CLAIM_MIN_IDLE_MS,
+            )
+            stale = [e["message_id"] for e in entries if e["consumer"] != consumer]
+            if stale:
+                # 配信回数は読み直し (XREADGROUP 0) で増えるので、引き取りでは増やさない
+                claimed += len(
+                    self.redis_client.xclaim(
+                        WRITE_BEHIND_STREAM,
+                        WRITE_BEHIND_GROUP,
+                        consumer,
+                        WRITE_BEHIND_CLAIM_MIN_IDLE_MS,
+                        stale,
+                        justid=True,
+                    )
+                )
+            if len(entries) < WRITE_BEHIND_BATCH_SIZE:
+                return claimed
+            start = "(" + entries[-1]["message_id"]
+
+    def _flush_write_behind(self, conn, consumer, messages):
+        # 何度配信しても反映できなかったエントリ (フラッシャごと落ちる行など) は書かずに外す
+        pending = self.redis_client.xpending_range(
+            WRITE_BEHIND_STREAM,
+            WRITE_BEHIND_GROUP,
+            min=messages[0][0],
+            max=messages[-1][0],
+            count=len(messages),
+            consumername=consumer,
+        )
+        deliveries = {p["message_id"]: p["times_delivered"] for p in pending}
+        dead = [
+            (msg_id, fields, "too many deliveries")
+            for msg_id, fields in messages
+            if deliveries.get(msg_id, 0) > WRITE_BEHIND_MAX_DELIVERIES
+        ]
+        dead_ids = {msg_id for msg_id, _, _ in dead}
+
+        # 同一キーへの連続書き込みは最後の値だけを残す (ストリームは追記順)
+        latest = {}
+        for msg_id, fields in messages:
+            if msg_id not in dead_ids:
+                latest[(fields["entity_type"], fields["entity_id"])] = (msg_id, fields)
+        rows = [
+            (t, i, fields["data"], write_stream_version(msg_id))
+            for (t, i), (msg_id, fields) in latest.items()
+        ]
+
+        try:
+            self._upsert_rows(conn, rows)
+        except DB_RETRYABLE_ERRORS:
+            raise
+        except psycopg2.Error:
+            # バッチ内のどれかの行が不正: 1行ずつ書き、それでも失敗する行だけデッドレターへ
+            conn.rollback()
+            self.write_behind_stats["row_retries"] += 1
+            written = []
+            for row, (msg_id, fields) in zip(rows, latest.values()):
+                try:
+                    self._upsert_rows(conn, [row])
+                    written.append(row)
+                except DB_RETRYABLE_ERRORS:
+                    raise
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    dead.append((msg_id, fields, str(e).strip()))
+            rows = written
+
+        # コミット後にACKして削除 (ここで落ちても再処理されるだけで冪等)
+        msg_ids = [msg_id for msg_id, _ in messages]
+        with self.redis_client.pipeline() as pipe:
+            for msg_id, fields, error in dead:
+                pipe.xadd(
+                    WRITE_BEHIND_DEAD_LETTER_STREAM,
+                    {
+                        **fields,
+                        "original_id": msg_id,
+                        "deliveries": deliveries.get(msg_id, 0),
+                        "error": error,
+                    },
+                )
+            pipe.xack(WRITE_BEHIND_STREAM, WRITE_BEHIND_GROUP, *msg_ids)
+            pipe.xdel(WRITE_BEHIND_STREAM, *msg_ids)
+            pipe.execute()
+        for msg_id, _, error in dead:
+            print(f"Write-behind entry {msg_id} dead-lettered: {error}")
+
+        self.write_behind_stats["batches"] += 1
+        self.write_behind_stats["flushed_rows"] += len(rows)
+        self.write_behind_stats["coalesced"] += len(messages) - len(latest) - len(dead_ids)
+        self.write_behind_stats["dead_lettered"] += len(dead)
+
+    @staticmethod
+    def _upsert_rows(conn, rows):
+        if not rows:
+            return
+        with conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO cache_data (entity_type, entity_id, data, updated_at, version)
+                VALUES %s
+                ON CONFLICT (entity_type, entity_id)
+                DO UPDATE SET
+                    data = EXCLUDED.data,
+                    updated_at = CURRENT_TIMESTAMP,
+                    version = EXCLUDED.version
+                WHERE cache_data.version IS NULL OR EXCLUDED.version > cache_data.version
+            """,
+                rows,
+                template="(%s, %s, %s, CURRENT_TIMESTAMP, %s)",
+                page_size=WRITE_BEHIND_BATCH_SIZE,
+            )
+        conn.commit()
+
+    def warmup(self, source=WARMUP_SOURCE, limit=WARMUP_LIMIT):
+        """ホットなエンティティをバッチで読み込み、パイプラインでキャッシュへ投入"""
+        if source not in ("recent", "access_log"):
+            raise ValueError(f"Unknown warmup source: {source}")
+        conn = self._connect_db()
+        loaded = 0
+        try:
+            if source == "recent":
+                with conn.cursor(name="warmup_recent") as cursor:
+                    cursor.itersize = WARMUP_BATCH_SIZE
+                    cursor.execute(
+                        """
+                        SELECT entity_type, entity_id, data, updated_at FROM cache_data
+                        ORDER BY updated_at DESC LIMIT %s
+                    """,
+                        (limit,),
+                    )
+                    while rows := cursor.fetchmany(WARMUP_BATCH_SIZE):
+                        loaded += self._cache_rows(rows, only_missing=True)
+                conn.commit()
+            else:
+                members = self.redis_client.zrevrange(ACCESS_LOG_KEY, 0, limit - 1)
+                for i in range(0, len(members), WARMUP_BATCH_SIZE):
+                    keys = [m.split(":", 1) for m in members[i : i + WARMUP_BATCH_SIZE]]
+                    rows = self._db_read_many(conn, keys)
+                    loaded += self._cache_rows(rows, only_missing=True)
+        finally:
+            conn.close()
+        self.warm_stats["warmed"] += loaded
+        return {"source": source, "loaded": loaded}
+
+    def _access_log_worker(self):
+        # リフレッシュ専用のDB接続
+        conn = self._connect_db()
+        while True:
+            try:
+                self._flush_access_log()
+                if self.refresh_ahead:
+                    self._refresh_ahead(conn)
+            except (redis.RedisError, psycopg2.Error) as e:
+                print(f"Refresh-ahead failed: {e}")
+                conn = self._recover_db(conn)
+            time.sleep(REFRESH_AHEAD_INTERVAL)
+
+    def _flush_access_log(self):
+        with self.access_lock:
+            counts, self.access_counts = self.access_counts, Counter()
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for member, count in counts.items():
+                pipe.zincrby(ACCESS_LOG_KEY, count, member)
+            # アクセスログは上位 ACCESS_LOG_MAX_ENTRIES 件だけ残す
+            pipe.zremrangebyrank(ACCESS_LOG_KEY, 0, -(ACCESS_LOG_MAX_ENTRIES + 1))
+            try:
+                pipe.execute()
+            except redis.RedisError:
+                # 送れなかったヒット数は次回に持ち越す
+                with self.access_lock:
+                    self.access_counts.update(counts)
+                raise
+        # 減衰はインターバルごとに最初に来たプロセスだけが行う
+        if self.redis_client.set(
+            ACCESS_LOG_DECAY_LOCK_KEY, 1, ex=ACCESS_LOG_DECAY_INTERVAL, nx=True
+        ):
+            self.redis_client.zunionstore(
+                ACCESS_LOG_KEY, {ACCESS_LOG_KEY: ACCESS_LOG_DECAY_FACTOR}
+            )
+
+    def _refresh_ahead(self, conn):
+        members = self.redis_client.zrevrange(ACCESS_LOG_KEY, 0, REFRESH_AHEAD_TOP_N - 1)
+        if not members:
+            return
+        cache_keys = [f"cache:{m}" for m in members]
+        with self.cache_client.pipeline(transaction=False) as pipe:
+            for cache_key in cache_keys:
+                pipe.ttl(cache_key)
+            ttls = pipe.execute()
+
+        # TTL切れ間近 (または期限切れ済み) のホットキーが対象
+        due = [
+            (member, cache_key, ttl)
+            for member, cache_key, ttl in zip(members, cache_keys, ttls)
+            if ttl == -2 or 0 <= ttl <= REFRESH_AHEAD_WINDOW
+        ]
+        if not due:
+            return
+        with self.cache_client.pipeline(transaction=False) as pipe:
+            for _, cache_key, _ in due:
+                pipe.get(cache_key)
+            values = pipe.execute()
+        # 墓石は自然に期限切れさせる
+        due = [d for d, value in zip(due, values) if value != TOMBSTONE]
+
+        if self.write_mode == "write_behind":
+            # DBはバッファ反映前で古い可能性があるため、キャッシュ上の値のTTLだけ延長する
+            live = [cache_key for _, cache_key, ttl in due if ttl != -2]
+            with self.cache_client.pipeline(transaction=False) as pipe:
+                for cache_key in live:
+                    pipe.expire(cache_key, CACHE_TTL)
+                pipe.execute()
+            self.warm_stats["extended"] += len(live)
+            return
+
+        for i in range(0, len(due), WARMUP_BATCH_SIZE):
+            keys = [m.split(":", 1) for m, _, _ in due[i : i + WARMUP_BATCH_SIZE]]
+            rows = self._db_read_many(conn, keys)
+            self.warm_stats["refreshed"] += self._cache_rows(rows, only_missing=False)
+
+    def _cache_rows(self, rows, only_missing):
+        # only_missing=True の場合は既存のキャッシュ (より新しい可能性がある) を上書きしない
+        with self.cache_client.pipeline(transaction=False) as pipe:
+            for entity_type, entity_id, data, updated_at in rows:
+                cache_key = f"cache:{entity_type}:{entity_id}"
+                entry = self._row_to_entity(entity_type, entity_id, data, updated_at)
+                if only_missing:
+                    pipe.set(cache_key, self._encode(entry), ex=CACHE_TTL, nx=True)
+                else:
+                    pipe.setex(cache_key, CACHE_TTL, self._encode(entry))
+            results = pipe.execute()
+        return sum(1 for r in results if r)
+
+    def _db_read_many(self, conn, keys):
+        if not keys:
+            return []
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT entity_type, entity_id, data, updated_at FROM cache_data
+                WHERE (entity_type, entity_id) IN %s
+            """,
+                (tuple(tuple(k) for k in keys),),
+            )
+            rows = cursor.fetchall()
+        conn.commit()
+        return rows
+
+    @staticmethod
+    def _row_to_entity(entity_type, entity_id, data, updated_at):
+        return {
+            "id": entity_id,
+            "type": entity_type,
+            "data": data,
+            "updated_at": updated_at.isoformat(),
         }
 
     def _db_read(self, entity_type, entity_id):
@@ -118,12 +685,7 @@ class CacheAsideKVS:
 
             if result:
                 data, updated_at = result
-                return {
-                    "id": entity_id,
-                    "type": entity_type,
-                    "data": data,
-                    "updated_at": updated_at.isoformat(),
-                }
+                return self._row_to_entity(entity_type, entity_id, data, updated_at)
             else:
                 return None  # Return None if not found in DB
 
@@ -144,6 +706,9 @@ class CacheAsideKVS:
 
 app = Flask(__name__)
 cache_kvs = CacheAsideKVS()
+if WARMUP_ON_START:
+    # 起動をブロックしないようバックグラウンドでウォームアップ
+    threading.Thread(target=cache_kvs.warmup, daemon=True).start()
 
 
 @app.route("/get/<entity_type>/<entity_id>")
@@ -166,6 +731,18 @@ def invalidate_cache(entity_type, entity_id=None):
     return jsonify(result)
 
 
+@app.route("/warmup", methods=["POST"])
+def warmup_cache():
+    body = request.get_json(silent=True) or {}
+    try:
+        result = cache_kvs.warmup(
+            body.get("source", WARMUP_SOURCE), int(body.get("limit", WARMUP_LIMIT))
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify(result)
+
+
 @app.route("/stats")
 def get_cache_stats():
     return jsonify(cache_kvs.get_stats())
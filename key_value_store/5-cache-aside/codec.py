@@ -0,0 +1,119 @@
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# ヘッダ: [フォーマットバージョン:1byte][シリアライザID:1byte][圧縮ID:1byte]
+# 旧形式 (json.dumps の文字列そのまま) は先頭バイトで判別して読めるようにしておく
+FORMAT_VERSION = 1
+HEADER_SIZE = 3
+
+SERIALIZERS = {"json": 0, "orjson": 1, "msgpack": 2}
+COMPRESSIONS = {"none": 0, "zlib": 1, "zstd": 2, "lz4": 3}
+
+
+def _serialize(serializer_id, value):
+    if serializer_id == SERIALIZERS["json"]:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if serializer_id == SERIALIZERS["orjson"]:
+        return orjson.dumps(value)
+    if serializer_id == SERIALIZERS["msgpack"]:
+        return msgpack.packb(value, use_bin_type=True)
+    raise ValueError(f"Unknown serializer id: {serializer_id}")
+
+
+def _deserialize(serializer_id, payload):
+    if serializer_id == SERIALIZERS["json"]:
+        return json.loads(payload)
+    if serializer_id == SERIALIZERS["orjson"]:
+        return orjson.loads(payload)
+    if serializer_id == SERIALIZERS["msgpack"]:
+        return msgpack.unpackb(payload, raw=False)
+    raise ValueError(f"Unknown serializer id: {serializer_id}")
+
+
+def _compress(compression_id, payload):
+    if compression_id == COMPRESSIONS["zlib"]:
+        return zlib.compress(payload)
+    if compression_id == COMPRESSIONS["zstd"]:
+        return zstandard.ZstdCompressor().compress(payload)
+    if compression_id == COMPRESSIONS["lz4"]:
+        return lz4.frame.compress(payload)
+    raise ValueError(f"Unknown compression id: {compression_id}")
+
+
+def _decompress(compression_id, payload):
+    if compression_id == COMPRESSIONS["none"]:
+        return payload
+    if compression_id == COMPRESSIONS["zlib"]:
+        return zlib.decompress(payload)
+    if compression_id == COMPRESSIONS["zstd"]:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if compression_id == COMPRESSIONS["lz4"]:
+        return lz4.frame.decompress(payload)
+    raise ValueError(f"Unknown compression id: {compression_id}")
+
+
+class ValueCodec:
+    """Encode cache values with a pluggable serializer and size-based compression."""
+
+    def __init__(self, serializer="json", compression="zlib", threshold=1024):
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unknown serializer: {serializer}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        # オプション依存は設定で選ばれた時だけ必須にする
+        available = {
+            "orjson": orjson,
+            "msgpack": msgpack,
+            "zstd": zstandard,
+            "lz4": lz4,
+        }
+        for name in (serializer, compression):
+            if name in available and available[name] is None:
+                raise RuntimeError(f"{name} is selected but not installed")
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = threshold
+        self._serializer_id = SERIALIZERS[serializer]
+        self._compression_id = COMPRESSIONS[compression]
+
+    def encode(self, value):
+        """Return (blob, serialized_size) so callers can track bytes saved."""
+        payload = _serialize(self._serializer_id, value)
+        serialized_size = len(payload)
+        compression_id = COMPRESSIONS["none"]
+        if self._compression_id and len(payload) >= self.threshold:
+            compressed = _compress(self._compression_id, payload)
+            # 圧縮しても小さくならない値はそのまま保存する
+            if len(compressed) < len(payload):
+                payload = compressed
+                compression_id = self._compression_id
+        header = bytes((FORMAT_VERSION, self._serializer_id, compression_id))
+        return header + payload, serialized_size
+
+    def decode(self, blob):
+        """Decode a blob written by any serializer/compression, or a legacy JSON string."""
+        if not blob or blob[0] != FORMAT_VERSION:
+            return json.loads(blob)
+        serializer_id, compression_id = blob[1], blob[2]
+        payload = _decompress(compression_id, blob[HEADER_SIZE:])
+        return _deserialize(serializer_id, payload)
@@ -1,11 +1,11 @@
 import os
-import threading
-import time
 from flask import Flask, request, jsonify
-from pybloom_live import BloomFilter
-from sortedcontainers import SortedDict
 import diskcache
 import redis
+import sstable
+from block_cache import LRUCache
+from compaction import LeveledCompactionPolicy
+from engine import LSMEngine, MISSING
 
 app = Flask(__name__)
 DATA_DIR = "./data"
@@ -17,6 +17,15 @@ REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
 redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
 
+def redis_lookup(key):
+    """cache_lookup for engine.get; a Redis error falls through to the SSTables."""
+    try:
+        value = redis_client.get(key)
+    except Exception as e:
+        return MISSING
+    return value if value is not None else MISSING
+
+
 @app.route("/write", methods=["POST"])
 def write():
     data = request.get_json()
@@ -24,15 +33,11 @@ def write():
         return jsonify({"status": "error", "message": "Missing key or value"}), 400
     key = data["key"]
     value = data["value"]
-    memtable[key] = value
-    bloom.add(key)
+    engine.put(key, value)
     try:
         redis_client.set(key, value)
     except Exception as e:
         pass
-    if len(memtable) >= MEMTABLE_LIMIT:
-        write_sstable(memtable)
-        memtable.clear()
     return jsonify({"status": "ok", "key": key, "value": value})
 
 
@@ -41,83 +46,48 @@ def read():
     key = request.args.get("key")
     if not key:
         return jsonify({"status": "error", "message": "Missing key"}), 400
-    if key in memtable:
-        return jsonify({"status": "ok", "key": key, "value": memtable[key]})
-    try:
-        value = redis_client.get(key)
-        if value is not None:
-            return jsonify({"status": "ok", "key": key, "value": value})
-    except Exception as e:
-        pass
-    # SSTable fallback
-    for fname in sorted([f for f in os.listdir(DATA_DIR) if f.startswith("sstable_")]):
-        with open(os.path.join(DATA_DIR, fname)) as f:
-            for line in f:
-                k, v = line.strip().split("\t")
-                if k == key:
-                    return jsonify({"status": "ok", "key": key, "value": v})
+    # MemTable -> Redis -> SSTable fallback
+    value, _ = engine.get(key, cache_lookup=redis_lookup)
+    if value is not None:
+        return jsonify({"status": "ok", "key": key, "value": value})
     return jsonify({"status": "not_found", "key": key}), 404
 
 
-# Bloom Filter for fast lookups
-bloom = BloomFilter(capacity=10000, error_rate=0.001)
-
-# MemTable (in-memory sorted)
-memtable = SortedDict()
-MEMTABLE_LIMIT = 1000
-
-# Commit Log (WAL)
-WAL_PATH = os.path.join(DATA_DIR, "commit.log")
-
-
-# SSTable (disk sorted)
-def write_sstable(data, level=0):
-    """Write data to SSTable file."""
-    fname = os.path.join(DATA_DIR, f"sstable_level{level}_{int(time.time())}.sst")
-    with open(fname, "w") as f:
-        for k, v in data.items():
-            f.write(f"{k}\t{v}\n")
-    return fname
-
-
-def read_sstable(key):
-    """Search a key across SSTable files without full load into memory."""
-    files = sorted([f for f in os.listdir(DATA_DIR) if f.startswith("sstable_")])
-    for fname in files:
-        with open(os.path.join(DATA_DIR, fname)) as f:
-            for line in f:
-                k, v = line.strip().split("\t", 1)
-                if k == key:
-                    return v
-    return None
-
-
-# LSM-Tree compaction
-def lsm_compact():
-    """Compact SSTable files."""
-    files = sorted([f for f in os.listdir(DATA_DIR) if f.startswith("sstable_")])
-    if len(files) > 2:
-        merged = SortedDict()
-        for fname in files:
-            with open(os.path.join(DATA_DIR, fname)) as f:
-                for line in f:
-                    k, v = line.strip().split("\t")
-                    merged[k] = v
-        out = write_sstable(merged, level=1)
-        for fname in files:
-            os.remove(os.path.join(DATA_DIR, fname))
-
-
-# L1/L2 cache
-l1_cache = memtable
+# SSTable (disk sorted, block-based)
+# リクエストスレッド間で共有するデコード済みブロックのLRUキャッシュ (と任意の行キャッシュ)
+BLOCK_CACHE_BYTES = int(os.environ.get("BLOCK_CACHE_BYTES", 32 * 1024 * 1024))
+ROW_CACHE_ENTRIES = int(os.environ.get("ROW_CACHE_ENTRIES", 0))
+sstable.set_caches(
+    LRUCache(BLOCK_CACHE_BYTES) if BLOCK_CACHE_BYTES > 0 else None,
+    LRUCache(ROW_CACHE_ENTRIES) if ROW_CACHE_ENTRIES > 0 else None,
+)
+# 新しく書くデータブロックの圧縮方式 (none / zlib / lz4)
+sstable.set_block_compression(os.environ.get("SSTABLE_COMPRESSION", "zlib"))
+
+# Storage engine (WAL + MemTable + Leveled SSTables, engine.py)
+# 起動時にMANIFESTのSSTableを開いてWALを再生し、フラッシュとコンパクションのスレッドを起動する
+engine = LSMEngine(
+    DATA_DIR,
+    LeveledCompactionPolicy(
+        l0_trigger=int(os.environ.get("L0_COMPACTION_TRIGGER", 4)),
+        level_base_bytes=int(os.environ.get("LEVEL_BASE_BYTES", 4 * 1024 * 1024)),
+        target_file_size=int(os.environ.get("TARGET_FILE_SIZE", 2 * 1024 * 1024)),
+    ),
+    memtable_limit=1000,
+    max_immutable_memtables=int(os.environ.get("MAX_IMMUTABLE_MEMTABLES", 4)),
+    wal_sync_interval_ms=float(os.environ.get("WAL_SYNC_INTERVAL_MS", 1)),
+    compaction_check_interval=int(os.environ.get("COMPACTION_CHECK_INTERVAL", 30)),
+    logger=app.logger,
+)
+
+SCAN_DEFAULT_LIMIT = 100
+SCAN_MAX_LIMIT = 1000
+
+
+# L1 (MemTable) / L2 cache
 l2_cache = diskcache.Cache(os.path.join(DATA_DIR, "l2cache"))
-
-
-# WAL write
-def write_wal(key, value):
-    """Write to Write-Ahead Log."""
-    with open(WAL_PATH, "a") as f:
-        f.write(f"{key}\t{value}\n")
+# engine.get の読み込み元 -> /get の "cache"
+GET_SOURCES = {"memtable": "L1", "cache": "L2", "sstable": "SSTable"}
 
 
 @app.route("/put", methods=["POST"])
@@ -125,13 +95,8 @@ def put():
     """Put key-value pair."""
     key = request.json.get("key")
     value = request.json.get("value")
-    bloom.add(key)
-    memtable[key] = value
+    engine.put(key, value)
     l2_cache[key] = value
-    write_wal(key, value)
-    if len(memtable) >= MEMTABLE_LIMIT:
-        write_sstable(memtable)
-        memtable.clear()
     return jsonify({"status": "ok"})
 
 
@@ -139,40 +104,76 @@ def put():
 def get():
     """Get value for key."""
     key = request.args.get("key")
-    if key not in bloom:
+    # MemTable (L1) -> L2 -> SSTable (全読み込みではなく直接検索)
+    value, source = engine.get(key, cache_lookup=lambda k: l2_cache.get(k, MISSING))
+    if source is None:
         return jsonify({"found": False})
-    if key in l1_cache:
-        return jsonify({"value": l1_cache[key], "cache": "L1"})
-    if key in l2_cache:
-        return jsonify({"value": l2_cache[key], "cache": "L2"})
+    return jsonify({"value": value, "cache": GET_SOURCES[source]})
 
-    # 変更点: 全読み込みではなく直接検索
-    value = read_sstable(key)
-    if value is not None:
-        return jsonify({"value": value, "cache": "SSTable"})
 
-    return jsonify({"found": False})
+@app.route("/scan", methods=["GET"])
+def scan_range():
+    """Range/prefix scan. Use next_start from the response to fetch the next page."""
+    start = request.args.get("start")
+    end = request.args.get("end")
+    prefix = request.args.get("prefix")
+    try:
+        limit = int(request.args.get("limit", SCAN_DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+    # 0以下だとページが進まず、負の値だと全件を返してしまう
+    if not 1 <= limit <= SCAN_MAX_LIMIT:
+        return (
+            jsonify(
+                {"status": "error", "message": f"limit must be between 1 and {SCAN_MAX_LIMIT}"}
+            ),
+            400,
+        )
+    items = []
+    next_start = None
+    for key, value in engine.scan(start, end, prefix):
+        if len(items) == limit:
+            # 続きがある場合だけ次ページの開始キーを返す
+            next_start = key
+            break
+        items.append({"key": key, "value": value})
+    return jsonify({"status": "ok", "items": items, "next_start": next_start})
 
 
 @app.route("/compact", methods=["POST"])
 def compact():
     """Trigger compaction."""
-    lsm_compact()
-    return jsonify({"status": "compacted"})
+    compactions = engine.compact(force=True)
+    return jsonify({"status": "compacted", "compactions": compactions})
 
 
 @app.route("/stats", methods=["GET"])
 def stats():
     """Get statistics."""
+    readers = engine.sstable_readers()
     return jsonify(
         {
-            "memtable_size": len(memtable),
-            "bloom_items": bloom.count,
-            "l1_cache": len(l1_cache),
+            "memtable_size": len(engine.memtable),
+            "immutable_memtables": len(engine.immutable_memtables),
+            **engine.flush_stats,
+            "wal_records": engine.wal.stats["records"],
+            "wal_bytes": engine.wal.stats["bytes"],
+            "wal_syncs": engine.wal.stats["syncs"],
+            "wal_segments": engine.wal.segment_count,
+            "bloom_filter_bytes": sum(r.bloom_size for r in readers),
+            **engine.read_stats,
+            "l1_cache": len(engine.memtable)
+            + sum(len(m) for m, _ in engine.immutable_memtables),
             "l2_cache": len(l2_cache),
-            "sstable_files": len(
-                [f for f in os.listdir(DATA_DIR) if f.startswith("sstable_")]
-            ),
+            "sstable_files": len(readers),
+            "sstable_blocks": sum(r.block_count for r in readers),
+            "levels": [
+                {"files": len(level), "bytes": sum(r.file_size for r in level)}
+                for level in engine.current_version.levels
+            ],
+            **engine.compaction_stats,
+            "block_cache": sstable.block_cache.stats() if sstable.block_cache else None,
+            "row_cache": sstable.row_cache.stats() if sstable.row_cache else None,
         }
     )
 
@@ -187,15 +188,5 @@ def health():
         return jsonify({"status": "error", "message": str(e)}), 503
 
 
-# Background compaction
-def compact_worker():
-    """Background compaction worker."""
-    while True:
-        lsm_compact()
-        time.sleep(30)
-
-
-threading.Thread(target=compact_worker, daemon=True).start()
-
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,231 @@
+"""YCSB-style benchmark that drives the storage engine modules in-process.
+
+No Flask or Redis is involved: the workloads call the same LSMEngine
+(engine.py) that app.py serves, so writes go through the WAL and the
+skip-list memtable, full memtables are flushed to L0 SSTables and compacted
+by its background threads, and reads search memtables, then SSTables
+through their Bloom filters.
+
+    python benchmark.py --workload all --distribution zipfian --records 20000
+"""
+
+import argparse
+import itertools
+import json
+import random
+import shutil
+import tempfile
+import time
+
+import sstable
+from block_cache import LRUCache
+from compaction import LeveledCompactionPolicy
+from engine import LSMEngine
+
+# 操作の比率はYCSBのコアワークロード (A, B, D, E) に合わせる
+WORKLOADS = {
+    "update-heavy": {"read": 0.5, "update": 0.5},
+    "read-heavy": {"read": 0.95, "update": 0.05},
+    "read-latest": {"read": 0.95, "insert": 0.05},
+    "scan": {"scan": 0.95, "insert": 0.05},
+}
+MAX_SCAN_LENGTH = 100
+ZIPFIAN_CONSTANT = 0.99
+FNV_OFFSET = 0xCBF29CE484222325
+FNV_PRIME = 0x100000001B3
+
+
+def _fnv64(n):
+    h = FNV_OFFSET
+    for _ in range(8):
+        h = ((h ^ (n & 0xFF)) * FNV_PRIME) & 0xFFFFFFFFFFFFFFFF
+        n >>= 8
+    return h
+
+
+def key_for(i):
+    # 連番をハッシュしてキー空間に散らす (挿入順とキー順を無関係にする)
+    return f"user{_fnv64(i):020d}"
+
+
+class ZipfianGenerator:
+    """Zipfian integers in [0, items), popular items first (Gray et al., as in YCSB)."""
+
+    def __init__(self, items, rng, theta=ZIPFIAN_CONSTANT):
+        self.items = items
+        self.rng = rng
+        self.theta = theta
+        self.alpha = 1 / (1 - theta)
+        self.zetan = sum(1 / (i**theta) for i in range(1, items + 1))
+        zeta2 = 1 + 1 / (2**theta)
+        self.eta = (1 - (2 / items) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + 0.5**self.theta:
+            return 1
+        return int(self.items * (self.eta * u - self.eta + 1) ** self.alpha)
+
+
+class KeyChooser:
+    """Pick the record index for reads and updates under a request distribution."""
+
+    def __init__(self, distribution, records, rng):
+        self.distribution = distribution
+        self.rng = rng
+        self.records = records
+        self.zipf = ZipfianGenerator(records, rng) if distribution != "uniform" else None
+
+    def next(self, inserted):
+        if self.distribution == "uniform":
+            return self.rng.randrange(inserted)
+        if self.distribution == "latest":
+            # 最近挿入したレコードほど選ばれやすい
+            return max(0, inserted - 1 - self.zipf.next())
+        # scrambled zipfian: 人気のレコードをキー空間全体に散らす
+        return _fnv64(self.zipf.next()) % inserted
+
+
+def amplification(engine):
+    written = (
+        engine.wal.stats["bytes"]
+        + engine.flush_stats["flush_bytes"]
+        + engine.compaction_stats["bytes_written"]
+    )
+    user_bytes = engine.write_stats["user_bytes"]
+    gets = engine.read_stats["gets"]
+    return {
+        # ディスクに書いたバイト数 (WAL + フラッシュ + 圧縮) / ユーザーが書いたバイト数
+        "write_amplification": round(written / user_bytes, 3) if user_bytes else 0,
+        # 点読み込み1回あたりに読んだSSTableデータブロック数
+        "read_amplification": round(engine.read_stats["block_reads"] / gets, 3) if gets else 0,
+        "sstable_files": sum(len(level) for level in engine.current_version.levels),
+        "levels": [len(level) for level in engine.current_version.levels],
+    }
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples.sort()
+
+    def pct(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1e6, 1)
+
+    return {"count": len(samples), "p50_us": pct(0.50), "p99_us": pct(0.99), "max_us": pct(1.0)}
+
+
+def _value(rng, size):
+    return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz0123456789", k=size))
+
+
+def run_workload(name, distribution, args):
+    mix = WORKLOADS[name]
+    if name == "read-latest":
+        distribution = "latest"
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp(prefix="lsm-bench-", dir=args.dir)
+    sstable.set_caches(
+        LRUCache(args.block_cache_bytes) if args.block_cache_bytes > 0 else None, None
+    )
+    policy = LeveledCompactionPolicy(
+        l0_trigger=args.l0_trigger,
+        level_base_bytes=args.level_base_bytes,
+        target_file_size=args.target_file_size,
+    )
+    engine = LSMEngine(
+        directory,
+        policy,
+        memtable_limit=args.memtable_limit,
+        max_immutable_memtables=args.max_immutable,
+        wal_sync_interval_ms=args.wal_sync_interval_ms,
+    )
+    try:
+        # ロードフェーズ: records件を挿入順に書く
+        started = time.perf_counter()
+        for i in range(args.records):
+            engine.put(key_for(i), _value(rng, args.value_size))
+        engine.drain()
+        load_seconds = time.perf_counter() - started
+
+        # 実行フェーズは読み書きの増幅をフェーズ単位で見るため統計をリセットする
+        load_amp = amplification(engine)
+        engine.reset_stats()
+
+        chooser = KeyChooser(distribution, args.records, rng)
+        ops = list(mix)
+        weights = list(mix.values())
+        latencies = {op: [] for op in ops}
+        inserted = args.records
+        started = time.perf_counter()
+        for _ in range(args.operations):
+            op = rng.choices(ops, weights)[0]
+            t0 = time.perf_counter()
+            if op == "read":
+                engine.get(key_for(chooser.next(inserted)))
+            elif op == "update":
+                engine.put(key_for(chooser.next(inserted)), _value(rng, args.value_size))
+            elif op == "insert":
+                engine.put(key_for(inserted), _value(rng, args.value_size))
+                inserted += 1
+            else:
+                start = key_for(chooser.next(inserted))
+                list(itertools.islice(engine.scan(start), rng.randint(1, MAX_SCAN_LENGTH)))
+            latencies[op].append(time.perf_counter() - t0)
+        run_seconds = time.perf_counter() - started
+        engine.drain()
+
+        return {
+            "workload": name,
+            "distribution": distribution,
+            "records": args.records,
+            "operations": args.operations,
+            "load": {
+                "seconds": round(load_seconds, 3),
+                "throughput_ops_s": round(args.records / load_seconds, 1),
+                **load_amp,
+            },
+            "run": {
+                "seconds": round(run_seconds, 3),
+                "throughput_ops_s": round(args.operations / run_seconds, 1),
+                "latency": {op: _percentiles(samples) for op, samples in latencies.items()},
+                **amplification(engine),
+                "bloom_negatives": engine.read_stats["bloom_negatives"],
+                "compactions": engine.compaction_stats["compactions"],
+                "write_stalls": engine.flush_stats["write_stalls"],
+            },
+            "block_cache": sstable.block_cache.stats() if sstable.block_cache else None,
+        }
+    finally:
+        engine.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", choices=[*WORKLOADS, "all"], default="all")
+    parser.add_argument("--distribution", choices=["uniform", "zipfian"], default="zipfian")
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--operations", type=int, default=10000)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--memtable-limit", type=int, default=1000)
+    parser.add_argument("--max-immutable", type=int, default=4)
+    parser.add_argument("--wal-sync-interval-ms", type=float, default=0)
+    parser.add_argument("--l0-trigger", type=int, default=4)
+    parser.add_argument("--level-base-bytes", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--target-file-size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--block-cache-bytes", type=int, default=32 * 1024 * 1024)
+    parser.add_argument("--dir", default=None, help="parent directory for the temporary data")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    names = list(WORKLOADS) if args.workload == "all" else [args.workload]
+    results = [run_workload(name, args.distribution, args) for name in names]
+    print(json.dumps(results if len(results) > 1 else results[0], indent=2))
+
+
+if __name__ == "__main__":
+    main()
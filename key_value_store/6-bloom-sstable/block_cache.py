@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total charge of its entries."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.usage = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, charge=1):
+        if charge > self.capacity:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.usage -= old[1]
+            self._entries[key] = (value, charge)
+            self.usage += charge
+            # 容量を超えた分は最も古く使われたエントリから追い出す
+            while self.usage > self.capacity:
+                _, (_, evicted_charge) = self._entries.popitem(last=False)
+                self.usage -= evicted_charge
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total * 100, 2) if total else 0,
+            "entries": len(self._entries),
+            "usage": self.usage,
+            "capacity": self.capacity,
+        }
@@ -0,0 +1,44 @@
+import hashlib
+import math
+import struct
+
+# シリアライズ形式: (bit_count:u64, hash_count:u32) + ビット列
+HEADER = struct.Struct(">QI")
+
+
+class BloomFilter:
+    """Serializable Bloom filter sized for an expected key count and false positive rate."""
+
+    def __init__(self, bit_count, hash_count, bits=None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((bit_count + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, expected_keys, error_rate=0.01):
+        n = max(1, expected_keys)
+        bit_count = max(64, math.ceil(-n * math.log(error_rate) / (math.log(2) ** 2)))
+        hash_count = max(1, round(bit_count / n * math.log(2)))
+        return cls(bit_count, hash_count)
+
+    def _positions(self, key):
+        # ダブルハッシュ: 128bitダイジェストを2つの64bit値に分けて k 個の位置を作る
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack(">QQ", digest)
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def to_bytes(self):
+        return HEADER.pack(self.bit_count, self.hash_count) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        bit_count, hash_count = HEADER.unpack_from(buf, 0)
+        return cls(bit_count, hash_count, bytearray(buf[HEADER.size :]))
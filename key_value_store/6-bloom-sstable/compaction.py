@@ -0,0 +1,118 @@
+import heapq
+import math
+import os
+
+from sstable import SSTableReader, SSTableWriter
+
+
+def _tagged(items, rank):
+    for key, value in items:
+        yield key, rank, value
+
+
+def merge_sorted(sources):
+    """K-way merge of sorted (key, value) iterators, newest source first.
+
+    Only the head of each source is held in memory. When several sources have
+    the same key, the value from the newest source (lowest index) wins.
+    """
+    last_key = None
+    for key, _, value in heapq.merge(*(_tagged(src, rank) for rank, src in enumerate(sources))):
+        if key != last_key:
+            last_key = key
+            yield key, value
+
+
+class CompactionJob:
+    def __init__(self, level, inputs, lower_inputs):
+        self.level = level
+        self.inputs = inputs
+        self.lower_inputs = lower_inputs
+
+    @property
+    def all_inputs(self):
+        # 上位レベル (新しいデータ) を先に並べる
+        return list(self.inputs) + list(self.lower_inputs)
+
+
+class LeveledCompactionPolicy:
+    """LevelDB-style leveled compaction.
+
+    L0 is compacted into L1 once it holds l0_trigger files. Level n (n >= 1) is
+    compacted into n + 1 one file at a time once its size exceeds
+    level_base_bytes * multiplier ** (n - 1).
+    """
+
+    def __init__(
+        self,
+        l0_trigger=4,
+        level_base_bytes=4 * 1024 * 1024,
+        multiplier=10,
+        target_file_size=2 * 1024 * 1024,
+        max_levels=5,
+    ):
+        self.l0_trigger = l0_trigger
+        self.level_base_bytes = level_base_bytes
+        self.multiplier = multiplier
+        self.target_file_size = target_file_size
+        self.max_levels = max_levels
+        # レベルごとに前回圧縮したファイルの最終キー (ラウンドロビンで選ぶため)
+        self._compact_pointer = {}
+
+    def max_bytes(self, level):
+        return self.level_base_bytes * self.multiplier ** (level - 1)
+
+    def pick(self, version, force=False):
+        """Return the next CompactionJob, or None if every level is within its threshold."""
+        l0 = version.levels[0]
+        if l0 and (len(l0) >= self.l0_trigger or force):
+            smallest = min(r.smallest for r in l0)
+            largest = max(r.largest for r in l0)
+            return CompactionJob(0, l0, version.overlapping(1, smallest, largest))
+
+        for level in range(1, min(len(version.levels), self.max_levels - 1)):
+            if version.level_bytes(level) <= self.max_bytes(level):
+                continue
+            files = version.levels[level]
+            pointer = self._compact_pointer.get(level)
+            chosen = next((r for r in files if pointer is None or r.smallest > pointer), files[0])
+            self._compact_pointer[level] = chosen.largest
+            return CompactionJob(
+                level, [chosen], version.overlapping(level + 1, chosen.smallest, chosen.largest)
+            )
+        return None
+
+    def run(self, job, new_path):
+        """Stream-merge the job's inputs into target-sized output files.
+
+        new_path() returns the path for each new output file. Returns the list of
+        readers for the written outputs.
+        """
+        inputs = job.all_inputs
+        total_entries = sum(r.entry_count for r in inputs)
+        total_bytes = sum(r.data_size for r in inputs)
+        # 出力1ファイルあたりの想定キー数 (ブルームフィルタのサイズ決め用)
+        avg_entry = total_bytes / total_entries if total_entries else 1
+        per_file = min(total_entries, math.ceil(self.target_file_size / avg_entry * 1.5))
+
+        outputs = []
+        writer = None
+        try:
+            for key, value in merge_sorted([r.items(fill_cache=False) for r in inputs]):
+                if writer is None:
+                    writer = SSTableWriter(new_path(), expected_keys=per_file)
+                writer.add(key, value)
+                if writer.data_size >= self.target_file_size:
+                    outputs.append(SSTableReader(writer.finish()))
+                    writer = None
+            if writer is not None:
+                outputs.append(SSTableReader(writer.finish()))
+        except Exception:
+            # 途中までの出力は捨てる (入力ファイルはまだ有効なまま)
+            if writer is not None:
+                writer.abort()
+            for reader in outputs:
+                reader.close()
+                os.remove(reader.path)
+            raise
+        return outputs
@@ -0,0 +1,385 @@
+import os
+import threading
+import time
+
+from compaction import merge_sorted
+from memtable import SkipListMemTable
+from sstable import (
+    SSTableReader,
+    write_sstable_file,
+    is_sstable,
+    convert_legacy_sstable,
+    upgrade_sstable,
+)
+from version import Version, load_manifest, save_manifest
+from wal import WriteAheadLog
+
+MISSING = object()
+
+
+def _file_number(name):
+    # sstable_{number}.sst / 旧形式 sstable_level{level}_{timestamp}.sst
+    return int(name[: -len(".sst")].rsplit("_", 1)[1])
+
+
+def _legacy_age_key(name):
+    # 旧形式は低いレベルほど新しく、同レベルでは番号 (時刻) が大きいほど新しい
+    parts = name[: -len(".sst")].split("_")
+    level = int(parts[1][len("level") :]) if len(parts) == 3 else 0
+    return level, -_file_number(name)
+
+
+class LSMEngine:
+    """
+    WAL + スキップリストMemTable + Leveled SSTable のストレージエンジン
+
+    app.py (HTTP API) と benchmark.py が同じ書き込み・読み込み・フラッシュ・
+    コンパクションの経路を使う。生成時に data_dir のSSTableを開いてWALを再生し、
+    フラッシュとコンパクションのバックグラウンドスレッドを起動する。
+    """
+
+    def __init__(
+        self,
+        data_dir,
+        compaction_policy,
+        memtable_limit=1000,
+        max_immutable_memtables=4,
+        wal_sync_interval_ms=1,
+        compaction_check_interval=30,
+        logger=None,
+    ):
+        self.data_dir = data_dir
+        self.compaction_policy = compaction_policy
+        self.memtable_limit = memtable_limit
+        # フラッシュが追いつかない時に書き込みを待たせる上限 (メモリ使用量の上限)
+        self.max_immutable_memtables = max_immutable_memtables
+        self.compaction_check_interval = compaction_check_interval
+        self.logger = logger
+
+        # MemTable (in-memory sorted, concurrent skip list)
+        # 書き込み中のMemTableと、フラッシュ待ちの不変MemTable (新しい順)
+        self.memtable = SkipListMemTable()
+        self.immutable_memtables = ()
+
+        # Commit Log (WAL): 単一のファイルハンドルにグループコミットで追記
+        self.wal = WriteAheadLog(data_dir, sync_interval_ms=wal_sync_interval_ms)
+
+        # write_lock はMemTableの切り替えだけを守る。書き込み同士はMemTableのストライプロックで並行に進み、
+        # 切り替え (freezing) 中は進行中の書き込みが抜けるのを待ってからWALセグメントを切り替える
+        self.write_lock = threading.Condition()
+        self._active_writers = 0
+        self._freezing = False
+        self._closed = False
+
+        # 現在有効なSSTableの集合。差し替えは version_lock 下で新しいVersionを代入して行う
+        self.current_version = Version([[]])
+        self.version_lock = threading.Lock()
+        self.next_file_number = 1
+        self.compaction_lock = threading.Lock()
+        self.compaction_event = threading.Event()
+
+        self.write_stats = {"user_bytes": 0}
+        self.flush_stats = {"flushes": 0, "write_stalls": 0, "flush_bytes": 0}
+        # ブルームフィルタの効果測定
+        self.read_stats = {
+            "gets": 0,
+            "bloom_negatives": 0,
+            "bloom_false_positives": 0,
+            "block_reads": 0,
+        }
+        self.compaction_stats = {"compactions": 0, "bytes_read": 0, "bytes_written": 0}
+
+        self.load_sstables()
+        self.recover_memtable()
+        self._workers = [
+            threading.Thread(target=self._flush_worker, daemon=True),
+            threading.Thread(target=self._compact_worker, daemon=True),
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _log_error(self, message):
+        if self.logger:
+            self.logger.error(message)
+
+    def reset_stats(self):
+        for stats in (
+            self.write_stats,
+            self.flush_stats,
+            self.read_stats,
+            self.compaction_stats,
+            self.wal.stats,
+        ):
+            for k in stats:
+                stats[k] = 0
+
+    # Write path
+    def put(self, key, value):
+        """Log a write, apply it to the memtable, and return once the log record is durable."""
+        with self.write_lock:
+            while self._freezing or len(self.immutable_memtables) >= self.max_immutable_memtables:
+                if not self._freezing:
+                    self.flush_stats["write_stalls"] += 1
+                self.write_lock.wait()
+            table = self.memtable
+            self._active_writers += 1
+        try:
+            # 同じキーへの書き込みはWALとMemTableで同じ順序になるよう直列化する
+            with table.lock_for(key):
+                lsn = self.wal.append(key, value)
+                table.put(key, value)
+            # WALと同じく str() した値のバイト数で数える (JSONの数値なども書き込める)
+            self.write_stats["user_bytes"] += len(str(key)) + len(str(value))
+        finally:
+            with self.write_lock:
+                self._active_writers -= 1
+                self.write_lock.notify_all()
+                if len(table) >= self.memtable_limit and table is self.memtable:
+                    self._freeze_memtable()
+        # fsyncはロック外で待つので、同時に来た書き込みが1回のfsyncを共有できる
+        self.wal.wait(lsn)
+
+    def _freeze_memtable(self):
+        """Swap in an empty memtable and hand the full one to the background flusher.
+
+        Must be called with write_lock held. Waits for in-flight writers so every
+        record in the rotated WAL segments is in the frozen memtable and vice versa.
+        """
+        if not self.memtable or self._freezing:
+            return
+        self._freezing = True
+        while self._active_writers:
+            self.write_lock.wait()
+        # 凍結するMemTableの分だけWALセグメントを切り替える
+        segments = self.wal.rotate()
+        # 読み込み側が取りこぼさないよう、不変リストに載せてから新しいMemTableに切り替える
+        self.immutable_memtables = ((self.memtable, segments),) + self.immutable_memtables
+        self.memtable = SkipListMemTable()
+        self._freezing = False
+        self.write_lock.notify_all()
+
+    def _flush_worker(self):
+        """Flush immutable memtables to L0 SSTables, oldest first."""
+        while True:
+            with self.write_lock:
+                while not self.immutable_memtables and not self._closed:
+                    self.write_lock.wait()
+                # 閉じる時に残っている不変MemTableはWALセグメントから次回の起動時に復旧する
+                if self._closed:
+                    return
+                frozen, segments = self.immutable_memtables[-1]
+            try:
+                # SSTableを公開してから不変MemTableを外す
+                reader = self.write_sstable(frozen)
+            except Exception as e:
+                self._log_error(f"Flush failed: {e}")
+                time.sleep(1)
+                continue
+            with self.write_lock:
+                self.immutable_memtables = self.immutable_memtables[:-1]
+                self.flush_stats["flushes"] += 1
+                self.flush_stats["flush_bytes"] += reader.file_size
+                self.write_lock.notify_all()
+            self.wal.remove(segments)
+
+    def recover_memtable(self):
+        """Replay WAL segments left by a previous run into the memtable."""
+        replayed = 0
+        with self.write_lock:
+            for key, value in self.wal.replay():
+                self.memtable.put(key, value)
+                replayed += 1
+            if len(self.memtable) >= self.memtable_limit:
+                self._freeze_memtable()
+        return replayed
+
+    def drain(self):
+        """Wait until every frozen memtable is flushed, then compact until no level is over its threshold."""
+        with self.write_lock:
+            while self.immutable_memtables:
+                self.write_lock.wait()
+        self.compact()
+
+    def close(self):
+        """Stop the background workers, close the WAL and every open SSTable.
+
+        No reads or writes may be in flight. Unflushed memtables stay in the WAL
+        segments and are replayed by the next LSMEngine on this data_dir.
+        """
+        with self.write_lock:
+            self._closed = True
+            self.write_lock.notify_all()
+        self.compaction_event.set()
+        # 実行中のフラッシュ・コンパクションは最後まで終わらせてから止まる
+        for worker in self._workers:
+            worker.join()
+        self.wal.close()
+        for reader in self.current_version.readers():
+            reader.close()
+
+    # SSTable (disk sorted, block-based)
+    def new_sstable_path(self):
+        with self.version_lock:
+            number = self.next_file_number
+            self.next_file_number += 1
+        return os.path.join(self.data_dir, f"sstable_{number:08d}.sst")
+
+    def load_sstables(self):
+        """Open the SSTables listed in the MANIFEST and remove leftovers from crashes."""
+        names = [
+            f
+            for f in os.listdir(self.data_dir)
+            if f.startswith("sstable_") and f.endswith(".sst")
+        ]
+        for fname in os.listdir(self.data_dir):
+            if fname.startswith("sstable_") and fname.endswith(".tmp"):
+                # 書き込み途中で落ちたファイル
+                os.remove(os.path.join(self.data_dir, fname))
+
+        manifest = load_manifest(self.data_dir)
+        if manifest is None:
+            # MANIFEST導入前のデータ: 既存ファイルを新しい順にすべてL0として扱う
+            levels = [sorted(names, key=_legacy_age_key)]
+            self.next_file_number = max((_file_number(n) for n in names), default=0) + 1
+        else:
+            levels = manifest["levels"]
+            self.next_file_number = manifest["next_file_number"]
+            live = {name for level in levels for name in level}
+            for name in names:
+                if name not in live:
+                    # MANIFESTに載る前に落ちたフラッシュ/圧縮の出力 (内容はWALか入力側に残っている)
+                    os.remove(os.path.join(self.data_dir, name))
+
+        readers = []
+        for level in levels:
+            level_readers = []
+            for name in level:
+                path = os.path.join(self.data_dir, name)
+                if not is_sstable(path):
+                    convert_legacy_sstable(path)
+                # ブルームフィルタを持たない旧バージョンのファイルは現行形式で書き直す
+                level_readers.append(upgrade_sstable(path))
+            readers.append(level_readers)
+        self.current_version = Version(readers)
+        save_manifest(self.data_dir, self.current_version, self.next_file_number)
+
+    def sstable_readers(self):
+        """Snapshot of open SSTable readers, newest data first."""
+        return list(self.current_version.readers())
+
+    def write_sstable(self, data):
+        """Write data to a new L0 SSTable, install it as the newest file and return its reader."""
+        fname = self.new_sstable_path()
+        write_sstable_file(fname, data.items(), expected_keys=len(data))
+        reader = SSTableReader(fname)
+        with self.version_lock:
+            self.current_version = self.current_version.with_flushed(reader)
+            save_manifest(self.data_dir, self.current_version, self.next_file_number)
+        self.compaction_event.set()
+        return reader
+
+    # Read path
+    def lookup_memtables(self, key):
+        """Look up key in the active memtable, then immutable memtables newest first."""
+        # 参照の取得順 (active -> immutable -> SSTable) がフラッシュの公開順と逆なので取りこぼさない
+        value = self.memtable.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        for frozen, _ in self.immutable_memtables:
+            value = frozen.get(key, MISSING)
+            if value is not MISSING:
+                return value
+        return MISSING
+
+    def read_sstable(self, key):
+        """Search SSTables newest first, skipping files whose Bloom filter rules the key out."""
+        # 読み込み中に圧縮でVersionが差し替わっても、手元のVersionは一貫したまま使える
+        version = self.current_version
+        for reader in version.candidates(key):
+            # フィルタはメモリ上にあるので「存在しない」判定にディスクI/Oは不要
+            if not reader.may_contain(key):
+                self.read_stats["bloom_negatives"] += 1
+                continue
+            value = reader.get(key)
+            self.read_stats["block_reads"] += 1
+            if value is not None:
+                return value
+            self.read_stats["bloom_false_positives"] += 1
+        return None
+
+    def get(self, key, cache_lookup=None):
+        """Point read: memtables, then cache_lookup (if given), then SSTables.
+
+        cache_lookup(key) returns the cached value or MISSING. Returns
+        (value, source) with source "memtable", "cache" or "sstable", and
+        (None, None) if the key does not exist.
+        """
+        self.read_stats["gets"] += 1
+        value = self.lookup_memtables(key)
+        if value is not MISSING:
+            return value, "memtable"
+        if cache_lookup is not None:
+            value = cache_lookup(key)
+            if value is not MISSING:
+                return value, "cache"
+        value = self.read_sstable(key)
+        return value, "sstable" if value is not None else None
+
+    def scan(self, start=None, end=None, prefix=None):
+        """Yield (key, value) in key order over [start, end) and/or a prefix, newest version wins.
+
+        Sources are merged lazily, so only one block per SSTable is held in memory.
+        """
+        if prefix and (start is None or start < prefix):
+            start = prefix
+        # 参照の取得順は点読み込みと同じ (MemTable -> 不変MemTable -> Version)
+        # スキップリストは書き込みと並行に走査できるので、書き込み中のMemTableも複製せずに読む
+        active = self.memtable
+        frozen = self.immutable_memtables
+        version = self.current_version
+        sources = [active.items(start, end)]
+        sources += [table.items(start, end) for table, _ in frozen]
+        sources += version.range_sources(start, end)
+        for key, value in merge_sorted(sources):
+            if end is not None and key >= end:
+                break
+            if prefix and not key.startswith(prefix):
+                break
+            yield key, value
+
+    # LSM-Tree compaction
+    def compact(self, force=False):
+        """Run compactions picked by the leveled policy until every level is within its threshold."""
+        done = 0
+        with self.compaction_lock:
+            while True:
+                job = self.compaction_policy.pick(self.current_version, force=force and done == 0)
+                if job is None:
+                    break
+                outputs = self.compaction_policy.run(job, self.new_sstable_path)
+                with self.version_lock:
+                    # 圧縮中にフラッシュされたL0ファイルはそのまま残して差分だけ適用する
+                    self.current_version = self.current_version.with_compaction(
+                        job.level, job.all_inputs, outputs
+                    )
+                    save_manifest(self.data_dir, self.current_version, self.next_file_number)
+                # 参照中の読み込みは開いているファイルディスクリプタで読み続けられる
+                for reader in job.all_inputs:
+                    os.remove(reader.path)
+                self.compaction_stats["compactions"] += 1
+                self.compaction_stats["bytes_read"] += sum(r.file_size for r in job.all_inputs)
+                self.compaction_stats["bytes_written"] += sum(r.file_size for r in outputs)
+                done += 1
+        return done
+
+    def _compact_worker(self):
+        """Background compaction worker (woken by flushes, runs only when a level is over its threshold)."""
+        while True:
+            self.compaction_event.wait(timeout=self.compaction_check_interval)
+            self.compaction_event.clear()
+            if self._closed:
+                return
+            try:
+                self.compact()
+            except Exception as e:
+                self._log_error(f"Compaction failed: {e}")
@@ -0,0 +1,185 @@
+import random
+import threading
+import zlib
+
+MAX_HEIGHT = 16
+BRANCHING = 4
+LOCK_STRIPES = 64
+
+
+class _Node:
+    __slots__ = ("key", "value", "next")
+
+    def __init__(self, key, value, height):
+        self.key = key
+        self.value = value
+        self.next = [None] * height
+
+
+class SkipListMemTable:
+    """Sorted in-memory table that many request threads can read and write at once.
+
+    Readers never lock: a new node is fully built before it is linked in, and
+    links are published bottom-up, so a concurrent traversal sees either the old
+    or the new list at every level. Overwriting an existing key is a single
+    attribute store. Only linking a new node takes a short internal lock.
+
+    lock_for(key) returns one of LOCK_STRIPES locks. Callers that must order
+    writes to the same key with something else (e.g. the WAL) hold it around
+    both steps; writes to keys on different stripes proceed in parallel.
+    """
+
+    def __init__(self):
+        self._head = _Node(None, None, MAX_HEIGHT)
+        self._height = 1
+        self._size = 0
+        self._insert_lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def lock_for(self, key):
+        return self._stripes[zlib.crc32(key.encode("utf-8")) % LOCK_STRIPES]
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        node = self._find(key)
+        return default if node is None else node.value
+
+    def put(self, key, value):
+        node = self._find(key)
+        if node is not None:
+            node.value = value
+            return
+        with self._insert_lock:
+            preds = self._predecessors(key)
+            node = preds[0].next[0]
+            # ロック待ちの間に同じキーが挿入されていたら上書きで済ませる
+            if node is not None and node.key == key:
+                node.value = value
+                return
+            height = self._random_height()
+            node = _Node(key, value, height)
+            for level in range(height):
+                node.next[level] = preds[level].next[level]
+            # 下のレベルから繋ぐ。途中の状態でも読み込み側は正しい位置に辿り着ける
+            for level in range(height):
+                preds[level].next[level] = node
+            if height > self._height:
+                self._height = height
+            self._size += 1
+
+    def items(self, start=None, end=None):
+        """Iterate (key, value) over [start, end) in key order.
+
+        The iteration is weakly consistent: it never fails under concurrent
+        writes, and may or may not include entries written after it started.
+        """
+        node = self._head
+        if start is not None:
+            for level in range(self._height - 1, -1, -1):
+                nxt = node.next[level]
+                while nxt is not None and nxt.key < start:
+                    node = nxt
+                    nxt = node.next[level]
+        node = node.next[0]
+        while node is not None:
+            if end is not None and node.key >= end:
+                return
+            yield node.key, node.value
+            node = node.next[0]
+
+    def _find(self, key):
+        node = self._head
+        for level in range(self._height - 1, -1, -1):
+            nxt = node.next[level]
+            while nxt is not None and nxt.key < key:
+                node = nxt
+                nxt = node.next[level]
+        node = node.next[0]
+        return node if node is not None and node.key == key else None
+
+    def _predecessors(self, key):
+        preds = [self._head] * MAX_HEIGHT
+        node = self._head
+        for level in range(MAX_HEIGHT - 1, -1, -1):
+            nxt = node.next[level]
+            while nxt is not None and nxt.key < key:
+                node = nxt
+                nxt = node.next[level]
+            preds[level] = node
+        return preds
+
+    @staticmethod
+    def _random_height():
+        height = 1
+        while height < MAX_HEIGHT and random.randrange(BRANCHING) == 0:
+            height += 1
+        return height
+
+
+def stress_test(threads=8, keys=2000, rounds=5):
+    """Hammer one memtable from many threads and report lost updates.
+
+    Each thread owns a disjoint counter per key and increments it under the
+    key's stripe lock, while reader threads scan concurrently. Every increment
+    must be visible at the end, and the table must stay sorted and duplicate-free.
+    """
+    table = SkipListMemTable()
+    stop = threading.Event()
+    errors = []
+
+    def writer(tid):
+        for r in range(rounds):
+            order = list(range(keys))
+            random.shuffle(order)
+            for i in order:
+                key = f"key:{i:06d}:{tid}"
+                shared = f"shared:{i:06d}"
+                table.put(key, r + 1)
+                # 全スレッドが同じキーを読み-変更-書き込みする。ストライプロックで直列化される
+                with table.lock_for(shared):
+                    table.put(shared, table.get(shared, 0) + 1)
+
+    def reader():
+        while not stop.is_set():
+            last = None
+            for key, _ in table.items():
+                if last is not None and key <= last:
+                    errors.append(f"out of order: {last!r} then {key!r}")
+                    return
+                last = key
+
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    writers = [threading.Thread(target=writer, args=(t,)) for t in range(threads)]
+    for t in readers + writers:
+        t.start()
+    for t in writers:
+        t.join()
+    stop.set()
+    for t in readers:
+        t.join()
+
+    lost = sum(1 for i in range(keys) if table.get(f"shared:{i:06d}") != threads * rounds)
+    lost += sum(
+        1 for i in range(keys) for t in range(threads) if table.get(f"key:{i:06d}:{t}") != rounds
+    )
+    entries = list(table.items())
+    return {
+        "threads": threads,
+        "expected_entries": keys * (threads + 1),
+        "entries": len(entries),
+        "len": len(table),
+        "sorted": all(a[0] < b[0] for a, b in zip(entries, entries[1:])),
+        "lost_updates": lost,
+        "reader_errors": errors,
+    }
+
+
+if __name__ == "__main__":
+    import json
+
+    print(json.dumps(stress_test(), indent=2))
@@ -0,0 +1,462 @@
+import itertools
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_left
+from bloom_filter import BloomFilter
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+# SSTableファイルレイアウト
+#   [data block 0][data block 1]...[index block][filter block][filter handle][footer]
+# data block   : (compression:u8) + ブロック本体 (compressionが0以外なら圧縮済み)。BLOCK_SIZE程度で区切る
+#   ブロック本体: エントリの並び + 再開点オフセット(u32)の配列 + 再開点の数(u32)
+#   エントリ    : (shared:varint, unshared:varint, value_len:varint, キーの差分, value)
+#                 直前のキーと共通する先頭sharedバイトを省略する。RESTART_INTERVAL件ごとの
+#                 再開点ではshared=0で完全なキーを持ち、ブロック内を二分探索できる
+# index block  : ブロックごとに (last_key_len:u32, offset:u64, size:u32, last_key)
+# filter block : ファイル内の全キーのブルームフィルタ (version 2以降)
+# filter handle: (filter_offset:u64, filter_size:u64) (version 2以降)
+# footer       : (index_offset:u64, index_size:u64, entry_count:u64, version:u32, magic:u32)
+# version 1/2 のdata blockは (key_len:u32, value_len:u32, key, value) の単純な並び
+MAGIC = 0x53535442  # "SSTB"
+FORMAT_VERSION = 3
+BLOCK_SIZE = 4096
+RESTART_INTERVAL = 16
+BLOOM_ERROR_RATE = 0.01
+
+COMPRESSIONS = {"none": 0, "zlib": 1, "lz4": 2}
+# 圧縮で12.5%以上小さくならないブロックは非圧縮で書く
+MIN_COMPRESSION_RATIO = 0.875
+block_compression = "zlib"
+
+ENTRY_HEADER = struct.Struct(">II")
+U32 = struct.Struct(">I")
+INDEX_ENTRY_HEADER = struct.Struct(">IQI")
+FILTER_HANDLE = struct.Struct(">QQ")
+FOOTER = struct.Struct(">QQQII")
+
+# 全リーダーで共有するキャッシュ (set_caches で設定、Noneなら無効)
+# block_cache: (file_id, block_index) -> デコード済みブロック。容量はブロックのバイト数で数える
+# row_cache  : (file_id, key) -> value。SSTableは不変なので書き込み時の無効化は不要
+block_cache = None
+row_cache = None
+_file_ids = itertools.count(1)
+
+
+def set_caches(blocks=None, rows=None):
+    global block_cache, row_cache
+    block_cache = blocks
+    row_cache = rows
+
+
+def set_block_compression(name):
+    """Select the compression used for newly written data blocks."""
+    global block_compression
+    if name not in COMPRESSIONS:
+        raise ValueError(f"Unknown block compression: {name}")
+    if name == "lz4" and lz4 is None:
+        raise RuntimeError("lz4 is selected but not installed")
+    block_compression = name
+
+
+def _put_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _get_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _compress_block(payload, compression):
+    compression_id = COMPRESSIONS[compression]
+    if compression_id == COMPRESSIONS["zlib"]:
+        compressed = zlib.compress(payload)
+    elif compression_id == COMPRESSIONS["lz4"]:
+        compressed = lz4.block.compress(payload)
+    else:
+        return bytes((0,)) + payload
+    if len(compressed) >= len(payload) * MIN_COMPRESSION_RATIO:
+        return bytes((0,)) + payload
+    return bytes((compression_id,)) + compressed
+
+
+def _block_payload(raw):
+    """Strip the compression header and decompress a version 3 data block."""
+    compression_id = raw[0]
+    if compression_id == COMPRESSIONS["none"]:
+        return raw[1:]
+    if compression_id == COMPRESSIONS["zlib"]:
+        return zlib.decompress(raw[1:])
+    if compression_id == COMPRESSIONS["lz4"]:
+        return lz4.block.decompress(raw[1:])
+    raise ValueError(f"Unknown block compression id: {compression_id}")
+
+
+def _decode_plain_block(buf):
+    """Decode a version 1/2 data block into parallel (keys, values) lists."""
+    keys, values = [], []
+    pos = 0
+    while pos < len(buf):
+        klen, vlen = ENTRY_HEADER.unpack_from(buf, pos)
+        pos += ENTRY_HEADER.size
+        keys.append(buf[pos : pos + klen].decode("utf-8"))
+        pos += klen
+        values.append(buf[pos : pos + vlen].decode("utf-8"))
+        pos += vlen
+    return keys, values
+
+
+def _read_entry(payload, pos, prev_key):
+    shared, pos = _get_varint(payload, pos)
+    unshared, pos = _get_varint(payload, pos)
+    vlen, pos = _get_varint(payload, pos)
+    key = prev_key[:shared] + payload[pos : pos + unshared]
+    pos += unshared
+    return key, payload[pos : pos + vlen], pos + vlen
+
+
+def _restart_points(payload):
+    (count,) = U32.unpack_from(payload, len(payload) - U32.size)
+    array_start = len(payload) - U32.size * (count + 1)
+    restarts = [U32.unpack_from(payload, array_start + i * U32.size)[0] for i in range(count)]
+    return restarts, array_start
+
+
+def _decode_block(payload):
+    """Decode a version 3 block payload into parallel (keys, values) lists."""
+    _, end = _restart_points(payload)
+    keys, values = [], []
+    pos = 0
+    key = b""
+    while pos < end:
+        key, value, pos = _read_entry(payload, pos, key)
+        keys.append(key.decode("utf-8"))
+        values.append(value.decode("utf-8"))
+    return keys, values
+
+
+def _search_block(payload, key):
+    """Find key in a version 3 block payload without decoding the whole block."""
+    target = key.encode("utf-8")
+    restarts, end = _restart_points(payload)
+    # 再開点のキー (完全なキー) を二分探索し、target以下の最後の再開点から線形に読む
+    lo, hi = 0, len(restarts)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        restart_key, _, _ = _read_entry(payload, restarts[mid], b"")
+        if restart_key <= target:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == 0:
+        return None
+    pos = restarts[lo - 1]
+    current = b""
+    while pos < end:
+        current, value, pos = _read_entry(payload, pos, current)
+        if current == target:
+            return value.decode("utf-8")
+        if current > target:
+            return None
+    return None
+
+
+class SSTableWriter:
+    """Write sorted key-value pairs into a block-based SSTable file."""
+
+    def __init__(self, path, block_size=BLOCK_SIZE, expected_keys=1000, compression=None):
+        self.path = path
+        self.block_size = block_size
+        self.compression = compression or block_compression
+        # フィルタはフラッシュ/圧縮時の想定キー数 (上限) でサイズを決める
+        self.bloom = BloomFilter.for_capacity(expected_keys, BLOOM_ERROR_RATE)
+        # 書き込み完了までは一時ファイルに書き、finish()でリネームして公開する
+        self._tmp_path = path + ".tmp"
+        self._f = open(self._tmp_path, "wb")
+        self._block = bytearray()
+        self._restarts = []
+        self._block_entries = 0
+        self._prev_key = b""
+        self._block_last_key = None
+        self._index = []
+        self._offset = 0
+        self.entry_count = 0
+        self._last_key = None
+
+    def add(self, key, value):
+        """Append one entry. Keys must be added in strictly ascending order."""
+        if self._last_key is not None and key <= self._last_key:
+            raise ValueError(f"Keys must be strictly ascending: {key!r} after {self._last_key!r}")
+        k = key.encode("utf-8")
+        v = str(value).encode("utf-8")
+        shared = 0
+        if self._block_entries % RESTART_INTERVAL == 0:
+            # 再開点: 完全なキーを書く
+            self._restarts.append(len(self._block))
+        else:
+            limit = min(len(k), len(self._prev_key))
+            while shared < limit and k[shared] == self._prev_key[shared]:
+                shared += 1
+        _put_varint(self._block, shared)
+        _put_varint(self._block, len(k) - shared)
+        _put_varint(self._block, len(v))
+        self._block += k[shared:]
+        self._block += v
+        self._prev_key = k
+        self._block_entries += 1
+        self.bloom.add(key)
+        self._block_last_key = key
+        self._last_key = key
+        self.entry_count += 1
+        if len(self._block) >= self.block_size:
+            self._flush_block()
+
+    @property
+    def data_size(self):
+        """Bytes of data blocks written so far (used to split compaction output)."""
+        return self._offset + len(self._block)
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        for restart in self._restarts:
+            self._block += U32.pack(restart)
+        self._block += U32.pack(len(self._restarts))
+        raw = _compress_block(bytes(self._block), self.compression)
+        self._f.write(raw)
+        self._index.append((self._block_last_key, self._offset, len(raw)))
+        self._offset += len(raw)
+        self._block = bytearray()
+        self._restarts = []
+        self._block_entries = 0
+        self._prev_key = b""
+
+    def finish(self):
+        """Write the index, filter and footer, fsync, and atomically move the file into place."""
+        self._flush_block()
+        index = bytearray()
+        for last_key, offset, size in self._index:
+            k = last_key.encode("utf-8")
+            index += INDEX_ENTRY_HEADER.pack(len(k), offset, size) + k
+        self._f.write(index)
+        bloom = self.bloom.to_bytes()
+        self._f.write(bloom)
+        self._f.write(FILTER_HANDLE.pack(self._offset + len(index), len(bloom)))
+        self._f.write(
+            FOOTER.pack(self._offset, len(index), self.entry_count, FORMAT_VERSION, MAGIC)
+        )
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+
+class SSTableReader:
+    """Point lookups over an SSTable using its in-memory sparse block index and Bloom filter."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            if file_size < FOOTER.size:
+                raise ValueError(f"{path} is too small to be an SSTable")
+            f.seek(file_size - FOOTER.size)
+            index_offset, index_size, entry_count, version, magic = FOOTER.unpack(
+                f.read(FOOTER.size)
+            )
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an SSTable (bad magic)")
+            if version not in (1, 2, FORMAT_VERSION):
+                raise ValueError(f"{path} has unsupported SSTable version {version}")
+            f.seek(index_offset)
+            index = f.read(index_size)
+            # version 1 のファイルはフィルタを持たないので常に「あるかもしれない」扱い
+            self.bloom = None
+            if version >= 2:
+                f.seek(file_size - FOOTER.size - FILTER_HANDLE.size)
+                filter_offset, filter_size = FILTER_HANDLE.unpack(
+                    f.read(FILTER_HANDLE.size)
+                )
+                f.seek(filter_offset)
+                self.bloom = BloomFilter.from_bytes(f.read(filter_size))
+        self.version = version
+        self.entry_count = entry_count
+        self.file_size = file_size
+        # 疎インデックス: ブロックごとの最終キーとファイル内の位置
+        self._last_keys = []
+        self._blocks = []
+        pos = 0
+        while pos < len(index):
+            klen, offset, size = INDEX_ENTRY_HEADER.unpack_from(index, pos)
+            pos += INDEX_ENTRY_HEADER.size
+            self._last_keys.append(index[pos : pos + klen].decode("utf-8"))
+            pos += klen
+            self._blocks.append((offset, size))
+        # ファイルはmmapして読む。圧縮でunlinkされても参照中の読み込みは継続できる
+        self._file_id = next(_file_ids)
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.smallest = self._read_block(0, fill_cache=False)[0][0] if self._blocks else None
+        self.largest = self._last_keys[-1] if self._blocks else None
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __del__(self):
+        # 最後の参照 (古いVersion) が消えた時点でマッピングを解放する
+        if getattr(self, "_mmap", None) is not None:
+            self.close()
+
+    @property
+    def block_count(self):
+        return len(self._blocks)
+
+    @property
+    def data_size(self):
+        return self._blocks[-1][0] + self._blocks[-1][1] if self._blocks else 0
+
+    def overlaps(self, smallest, largest):
+        return bool(self._blocks) and not (
+            self.largest < smallest or largest < self.smallest
+        )
+
+    def _read_block(self, i, fill_cache=True):
+        cache_key = (self._file_id, i)
+        if block_cache is not None:
+            block = block_cache.get(cache_key)
+            if block is not None:
+                return block
+        offset, size = self._blocks[i]
+        raw = self._mmap[offset : offset + size]
+        if self.version < 3:
+            block, charge = _decode_plain_block(raw), size
+        else:
+            payload = _block_payload(raw)
+            # キャッシュ容量は展開後のサイズで数える
+            block, charge = _decode_block(payload), len(payload)
+        if block_cache is not None and fill_cache:
+            block_cache.put(cache_key, block, charge=charge)
+        return block
+
+    def may_contain(self, key):
+        """False means the key is definitely not in this file (no disk I/O needed)."""
+        return self.bloom is None or key in self.bloom
+
+    @property
+    def bloom_size(self):
+        return len(self.bloom.bits) if self.bloom is not None else 0
+
+    def get(self, key):
+        """Return the value for key, or None. Reads at most one data block."""
+        if row_cache is not None:
+            value = row_cache.get((self._file_id, key))
+            if value is not None:
+                return value
+        # keyを含み得るのは最終キーがkey以上の最初のブロックだけ
+        i = bisect_left(self._last_keys, key)
+        if i == len(self._blocks):
+            return None
+        if block_cache is None and self.version >= 3:
+            # キャッシュしないならブロック全体をデコードせず再開点から探す
+            offset, size = self._blocks[i]
+            value = _search_block(_block_payload(self._mmap[offset : offset + size]), key)
+            if value is not None and row_cache is not None:
+                row_cache.put((self._file_id, key), value)
+            return value
+        keys, values = self._read_block(i)
+        j = bisect_left(keys, key)
+        if j < len(keys) and keys[j] == key:
+            if row_cache is not None:
+                row_cache.put((self._file_id, key), values[j])
+            return values[j]
+        return None
+
+    def items(self, start=None, fill_cache=True):
+        """Iterate entries with key >= start in key order, one block in memory at a time.
+
+        Pass fill_cache=False for bulk reads (e.g. compaction) so they do not evict hot blocks.
+        """
+        first = 0 if start is None else bisect_left(self._last_keys, start)
+        for i in range(first, len(self._blocks)):
+            keys, values = self._read_block(i, fill_cache)
+            j = bisect_left(keys, start) if i == first and start is not None else 0
+            yield from zip(keys[j:], values[j:])
+
+
+def write_sstable_file(path, items, block_size=BLOCK_SIZE, expected_keys=None):
+    """Write an iterable of (key, value) pairs in ascending key order to path."""
+    if expected_keys is None:
+        items = list(items)
+        expected_keys = len(items)
+    with SSTableWriter(path, block_size, expected_keys) as writer:
+        for key, value in items:
+            writer.add(key, value)
+    return path
+
+
+def is_sstable(path):
+    """True if path ends with a valid SSTable footer."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < FOOTER.size:
+                return False
+            f.seek(-FOOTER.size, os.SEEK_END)
+            return FOOTER.unpack(f.read(FOOTER.size))[4] == MAGIC
+    except OSError:
+        return False
+
+
+def upgrade_sstable(path):
+    """Rewrite an older-version SSTable in the current format (e.g. to add a Bloom filter)."""
+    reader = SSTableReader(path)
+    if reader.version == FORMAT_VERSION:
+        return reader
+    write_sstable_file(path, reader.items(fill_cache=False), expected_keys=reader.entry_count)
+    reader.close()
+    return SSTableReader(path)
+
+
+def convert_legacy_sstable(path):
+    """Rewrite a legacy tab-separated SSTable in place using the block format."""
+    entries = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            k, v = line.rstrip("\n").split("\t", 1)
+            entries[k] = v
+    # 旧形式はファイル内で重複・非ソートがあり得るので整列し直す
+    return write_sstable_file(path, sorted(entries.items()))
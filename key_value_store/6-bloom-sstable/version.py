@@ -0,0 +1,106 @@
+import json
+import os
+from bisect import bisect_left
+
+MANIFEST_NAME = "MANIFEST"
+
+
+class Version:
+    """Immutable snapshot of the live SSTables.
+
+    levels[0] holds flushed files newest first (key ranges may overlap).
+    levels[1:] hold files sorted by key with non-overlapping ranges, so at most
+    one file per level can contain a given key. Readers take a reference to the
+    current Version and keep using it even if compaction installs a new one.
+    """
+
+    def __init__(self, levels):
+        self.levels = [tuple(level) for level in levels]
+        self._largest = [[r.largest for r in level] for level in self.levels]
+
+    def candidates(self, key):
+        """Readers that may hold key, in search order (newest data first)."""
+        yield from self.levels[0]
+        for level, largest in zip(self.levels[1:], self._largest[1:]):
+            i = bisect_left(largest, key)
+            if i < len(level) and level[i].smallest <= key:
+                yield level[i]
+
+    def readers(self):
+        """All readers, newest data first."""
+        for level in self.levels:
+            yield from level
+
+    def range_sources(self, start=None, end=None):
+        """Sorted iterators over [start, end), newest data first, for a merge scan.
+
+        Each L0 file is its own source. Files in L1+ do not overlap, so each level
+        is chained into a single source that opens one file at a time.
+        """
+        sources = [r.items(start) for r in self.levels[0] if _in_range(r, start, end)]
+        for level in self.levels[1:]:
+            files = [r for r in level if _in_range(r, start, end)]
+            if files:
+                sources.append(_chain_level(files, start))
+        return sources
+
+    def level_bytes(self, level):
+        return sum(r.file_size for r in self.levels[level]) if level < len(self.levels) else 0
+
+    def overlapping(self, level, smallest, largest):
+        if level >= len(self.levels):
+            return []
+        return [r for r in self.levels[level] if r.overlaps(smallest, largest)]
+
+    def with_flushed(self, reader):
+        """New Version with a freshly flushed file as the newest L0 file."""
+        levels = list(self.levels)
+        levels[0] = (reader,) + levels[0]
+        return Version(levels)
+
+    def with_compaction(self, level, inputs, outputs):
+        """New Version with inputs removed and outputs added to level + 1."""
+        removed = {r.name for r in inputs}
+        levels = [[r for r in lvl if r.name not in removed] for lvl in self.levels]
+        while len(levels) <= level + 1:
+            levels.append([])
+        levels[level + 1] = sorted(levels[level + 1] + list(outputs), key=lambda r: r.smallest)
+        return Version(levels)
+
+    def to_manifest(self, next_file_number):
+        return {
+            "next_file_number": next_file_number,
+            "levels": [[r.name for r in level] for level in self.levels],
+        }
+
+
+def _in_range(reader, start, end):
+    if reader.smallest is None:
+        return False
+    if start is not None and reader.largest < start:
+        return False
+    return end is None or reader.smallest < end
+
+
+def _chain_level(files, start):
+    for reader in files:
+        yield from reader.items(start)
+
+
+def load_manifest(data_dir):
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(data_dir, version, next_file_number):
+    """Atomically replace the MANIFEST; the new file set becomes durable here."""
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(version.to_manifest(next_file_number), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,160 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+# レコード形式: (crc32:u32, payload_len:u32) + payload
+# payload      : (key_len:u32) + key + value
+RECORD_HEADER = struct.Struct(">II")
+KEY_HEADER = struct.Struct(">I")
+SEGMENT_PREFIX = "wal_"
+SEGMENT_SUFFIX = ".log"
+
+
+def _encode_record(key, value):
+    k = key.encode("utf-8")
+    payload = KEY_HEADER.pack(len(k)) + k + str(value).encode("utf-8")
+    return RECORD_HEADER.pack(zlib.crc32(payload), len(payload)) + payload
+
+
+def _segment_seq(name):
+    return int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+
+
+def list_segments(directory):
+    """WAL segment paths in write order."""
+    names = [
+        n
+        for n in os.listdir(directory)
+        if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX)
+    ]
+    return [os.path.join(directory, n) for n in sorted(names, key=_segment_seq)]
+
+
+def read_segment(path):
+    """Yield (key, value) records, stopping at the first torn or corrupt record."""
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        crc, length = RECORD_HEADER.unpack_from(data, pos)
+        payload = data[pos + RECORD_HEADER.size : pos + RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            # クラッシュ時に書きかけだった末尾のレコード
+            break
+        (klen,) = KEY_HEADER.unpack_from(payload, 0)
+        key = payload[KEY_HEADER.size : KEY_HEADER.size + klen].decode("utf-8")
+        value = payload[KEY_HEADER.size + klen :].decode("utf-8")
+        yield key, value
+        pos += RECORD_HEADER.size + length
+
+
+class WriteAheadLog:
+    """Append-only WAL with group commit: concurrent writers share one fsync per batch."""
+
+    def __init__(self, directory, sync_interval_ms=1):
+        self.directory = directory
+        self.sync_interval = sync_interval_ms / 1000
+        self._cond = threading.Condition()
+        self._buffer = bytearray()
+        self._last_lsn = 0
+        self._synced_lsn = 0
+        self._closed = False
+        self.stats = {"records": 0, "bytes": 0, "syncs": 0}
+        # 起動時に残っているセグメントは復旧用。次のフラッシュ後に削除できる
+        self._segments = list_segments(directory)
+        next_seq = _segment_seq(os.path.basename(self._segments[-1])) + 1 if self._segments else 1
+        self._open_segment(next_seq)
+        self._sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self._sync_thread.start()
+
+    def _open_segment(self, seq):
+        path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq:08d}{SEGMENT_SUFFIX}")
+        self._seq = seq
+        self._path = path
+        self._file = open(path, "ab")
+        self._segments.append(path)
+
+    def replay(self):
+        """Yield every record from segments left over from before this process started."""
+        for path in self._segments[:-1]:
+            yield from read_segment(path)
+
+    def append(self, key, value):
+        """Buffer one record and return its LSN. Call wait(lsn) before acknowledging."""
+        record = _encode_record(key, value)
+        with self._cond:
+            self._buffer += record
+            self._last_lsn += 1
+            self.stats["records"] += 1
+            self.stats["bytes"] += len(record)
+            self._cond.notify_all()
+            return self._last_lsn
+
+    def wait(self, lsn):
+        """Block until the record with this LSN has been fsynced."""
+        with self._cond:
+            while self._synced_lsn < lsn:
+                self._cond.wait()
+
+    def _sync_loop(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if not self._buffer:
+                    return
+            # 少し待って同時に来た書き込みを1回のfsyncにまとめる
+            if self.sync_interval:
+                time.sleep(self.sync_interval)
+            with self._cond:
+                buf, self._buffer = self._buffer, bytearray()
+                lsn = self._last_lsn
+                f = self._file
+            # write/fsync中もロックは持たないので、他の書き込みは次のバッチに溜まる
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+            with self._cond:
+                self._synced_lsn = lsn
+                self.stats["syncs"] += 1
+                self._cond.notify_all()
+
+    def rotate(self):
+        """Switch to a new segment and return the older segments.
+
+        The caller must stop new appends while rotating (records appended so far
+        belong to the memtable being flushed). Delete the returned segments with
+        remove() once that memtable is durable in an SSTable.
+        """
+        with self._cond:
+            while self._synced_lsn < self._last_lsn:
+                self._cond.wait()
+            self._file.close()
+            old = self._segments
+            self._segments = []
+            self._open_segment(self._seq + 1)
+            return old
+
+    def close(self):
+        """Sync everything appended so far, stop the sync thread and close the segment.
+
+        Segments are kept on disk; the next WriteAheadLog on this directory replays them.
+        """
+        with self._cond:
+            while self._synced_lsn < self._last_lsn:
+                self._cond.wait()
+            self._closed = True
+            self._cond.notify_all()
+        self._sync_thread.join()
+        self._file.close()
+
+    def remove(self, segments):
+        for path in segments:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @property
+    def segment_count(self):
+        return len(self._segments)
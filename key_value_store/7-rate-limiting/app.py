@@ -8,29 +8,145 @@ app = Flask(__name__)
 # Redis接続設定
 REDIS_HOST = os.environ.get("REDIS_HOST", "redis")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# REDIS_CLUSTER=true ならRedis Clusterに接続する
+# キーにはユーザーIDのハッシュタグ {user_id} を付け、1ユーザーの全アルゴリズムのキーを同じスロットに置く
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER", "false").lower() == "true"
+if REDIS_CLUSTER:
+    redis_client = redis.RedisCluster(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+else:
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
 
+# 各アルゴリズムはLuaスクリプトとしてRedis上で実行する
+# - 判定と更新が1回のEVALSHA (1往復) で原子的に行われ、並行リクエストでも上限を超えない
+# - register_script は初回以降スクリプト本体を送らずSHA1だけで呼び出す (NOSCRIPT時は自動で再送)
+# - 時刻はRedisのTIMEを使い、アプリサーバー間の時計のずれに影響されない
+
+# 固定ウィンドウ: KEYS[1]=カウンタ, ARGV[1]=上限, ARGV[2]=ウィンドウ秒
+FIXED_WINDOW_SCRIPT = redis_client.register_script(
+    """
+local current = redis.call('INCR', KEYS[1])
+if current == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+if current > tonumber(ARGV[1]) then
+    return 1
+end
+return 0
+"""
+)
+
+# トークンバケット: KEYS[1]=ハッシュ {tokens, ts}, ARGV[1]=容量, ARGV[2]=毎秒の補充数
+# キーあたりのメモリはフィールド2つで一定
+TOKEN_BUCKET_SCRIPT = redis_client.register_script(
+    """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+local limited = 1
+if tokens >= 1 then
+    tokens = tokens - 1
+    limited = 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+-- 満タンに戻るまでの時間が過ぎたら状態は不要
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return limited
+"""
+)
+
+# GCRA: KEYS[1]=理論到着時刻 (TAT, ミリ秒), ARGV[1]=上限, ARGV[2]=期間秒, ARGV[3]=バースト
+# キーあたり数値1つだけで、トークンバケットと同じ判定を行う
+GCRA_SCRIPT = redis_client.register_script(
+    """
+local limit = tonumber(ARGV[1])
+local period = tonumber(ARGV[2]) * 1000
+local burst = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local interval = period / limit
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+if new_tat - burst * interval > now then
+    return 1
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', math.ceil(new_tat - now))
+return 0
+"""
+)
+
+
+# スライディングウィンドウカウンタ: KEYS[1]=ハッシュ {ウィンドウ番号: 件数}, ARGV[1]=上限, ARGV[2]=ウィンドウ秒
+# 直前のウィンドウの件数を現在のウィンドウとの重なりの割合で重み付けして推定する
+# 保持するのは直近2ウィンドウ分のカウンタだけなので、メモリは上限に依らず一定
+SLIDING_COUNTER_SCRIPT = redis_client.register_script(
+    """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2]) * 1000
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local current = math.floor(now / window)
+local elapsed = (now % window) / window
+local counts = redis.call('HMGET', KEYS[1], current, current - 1)
+local estimate = (tonumber(counts[2]) or 0) * (1 - elapsed) + (tonumber(counts[1]) or 0)
+if estimate >= limit then
+    return 1
+end
+redis.call('HINCRBY', KEYS[1], current, 1)
+redis.call('HDEL', KEYS[1], current - 2)
+redis.call('PEXPIRE', KEYS[1], window * 2)
+return 0
+"""
+)
+
 # 固定ウィンドウカウンタアルゴリズム
 def is_rate_limited_fixed_window(user_id, limit=10, window=60):
-    key = f"rate_limit:fixed:{user_id}"
+    key = f"rate_limit:fixed:{{{user_id}}}"
+    return FIXED_WINDOW_SCRIPT(keys=[key], args=[limit, window]) == 1
+
 
-    current_requests = redis_client.get(key)
+# スライディングウィンドウカウンタアルゴリズム (2バケットによる近似)
+def is_rate_limited_sliding_counter(user_id, limit=10, window=60):
+    key = f"rate_limit:sliding_counter:{{{user_id}}}"
+    return SLIDING_COUNTER_SCRIPT(keys=[key], args=[limit, window]) == 1
 
-    if current_requests is None:
-        redis_client.setex(key, window, 1)
-        return False
 
-    if int(current_requests) >= limit:
-        return True
+def sliding_counter_estimate(user_id, window=60):
+    """Current weighted request estimate of the sliding window counter (read-only)."""
+    key = f"rate_limit:sliding_counter:{{{user_id}}}"
+    seconds, micros = redis_client.time()
+    now = seconds * 1000 + micros // 1000
+    window_ms = window * 1000
+    current = now // window_ms
+    elapsed = (now % window_ms) / window_ms
+    curr_count, prev_count = redis_client.hmget(key, current, current - 1)
+    return int(prev_count or 0) * (1 - elapsed) + int(curr_count or 0)
 
-    redis_client.incr(key)
-    return False
+
+# トークンバケットアルゴリズム (capacity回までバースト可、以降は毎秒refill_rate回)
+def is_rate_limited_token_bucket(user_id, capacity=10, refill_rate=10 / 60):
+    key = f"rate_limit:token_bucket:{{{user_id}}}"
+    return TOKEN_BUCKET_SCRIPT(keys=[key], args=[capacity, refill_rate]) == 1
+
+
+# GCRA (Generic Cell Rate Algorithm)
+def is_rate_limited_gcra(user_id, limit=10, period=60, burst=None):
+    key = f"rate_limit:gcra:{{{user_id}}}"
+    burst = limit if burst is None else burst
+    return GCRA_SCRIPT(keys=[key], args=[limit, period, burst]) == 1
 
 
 # スライディングウィンドウログアルゴリズム
 def is_rate_limited_sliding_window(user_id, limit=10, window=60):
-    key = f"rate_limit:sliding:{user_id}"
+    key = f"rate_limit:sliding:{{{user_id}}}"
     now = time.time()
 
     # トランザクション開始
@@ -68,6 +184,60 @@ def limited_sliding():
     return jsonify({"message": "Request successful"})
 
 
+@app.route("/limited_sliding_counter")
+def limited_sliding_counter():
+    user_id = request.args.get("user_id", "default_user")
+    if is_rate_limited_sliding_counter(user_id):
+        return jsonify({"error": "Rate limit exceeded"}), 429
+    return jsonify({"message": "Request successful"})
+
+
+@app.route("/compare_sliding")
+def compare_sliding():
+    """Compare the sliding log and sliding counter state of one user (accuracy vs cost)."""
+    user_id = request.args.get("user_id", "default_user")
+    window = 60
+    log_key = f"rate_limit:sliding:{{{user_id}}}"
+    counter_key = f"rate_limit:sliding_counter:{{{user_id}}}"
+    # ログは直近windowのリクエストを全て持つので正確な件数になる
+    exact = redis_client.zcount(log_key, time.time() - window, "+inf")
+    estimate = sliding_counter_estimate(user_id, window)
+    return jsonify(
+        {
+            "user_id": user_id,
+            "sliding_log": {
+                "requests_in_window": exact,
+                "memory_bytes": redis_client.memory_usage(log_key) or 0,
+                "stored_entries": redis_client.zcard(log_key),
+                "commands_per_request": 4,
+            },
+            "sliding_counter": {
+                "estimated_requests": round(estimate, 2),
+                "memory_bytes": redis_client.memory_usage(counter_key) or 0,
+                "stored_entries": redis_client.hlen(counter_key),
+                "commands_per_request": 1,
+            },
+            "estimate_error": round(estimate - exact, 2),
+        }
+    )
+
+
+@app.route("/limited_token_bucket")
+def limited_token_bucket():
+    user_id = request.args.get("user_id", "default_user")
+    if is_rate_limited_token_bucket(user_id):
+        return jsonify({"error": "Rate limit exceeded"}), 429
+    return jsonify({"message": "Request successful"})
+
+
+@app.route("/limited_gcra")
+def limited_gcra():
+    user_id = request.args.get("user_id", "default_user")
+    if is_rate_limited_gcra(user_id):
+        return jsonify({"error": "Rate limit exceeded"}), 429
+    return jsonify({"message": "Request successful"})
+
+
 @app.route("/health", methods=["GET"])
 def health():
     try:
@@ -0,0 +1,251 @@
+"""Benchmark the rate-limiting algorithms against a local Redis stand-in.
+
+Runs the limiter functions of app.py (fixed window, sliding window log,
+sliding window counter, token bucket, GCRA) and check_rate_limit of
+rate_limiter_design/app/main.py in-process, pointed at fakeredis (default,
+needs `fakeredis[lua]`) or at a local redis-server via --redis-url.
+
+    python benchmark.py --algorithms all --threads 8 --keys 100 --pattern burst
+    python benchmark.py --redis-url redis://localhost:6379/15 --duration 10
+
+Every `rate_limit:*` key on the target is deleted before each algorithm runs,
+so point --redis-url at a throwaway instance or database.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+from bisect import bisect_right
+
+import redis
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DESIGN_APP_DIR = os.path.join(HERE, "..", "..", "rate_limiter_design", "app")
+PATTERNS = ("steady", "burst", "flood")
+MEMORY_SAMPLE_KEYS = 100
+
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_client(redis_url):
+    if redis_url:
+        return redis.Redis.from_url(redis_url, decode_responses=True)
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("fakeredis is not installed: pip install -r requirements_local.txt (or pass --redis-url)")
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def load_algorithms(client, limit, window):
+    """
+    各アルゴリズムを「limited を返す関数」にまとめる
+
+    モジュールは import 時に自前のRedisクライアントを作る (接続は遅延) ので、
+    import 後にベンチマーク用のクライアントへ差し替える。
+    """
+    algorithms = {}
+
+    limiter = _load_module("rate_limiting_app", os.path.join(HERE, "app.py"))
+    limiter.redis_client = client
+    for script in (
+        limiter.FIXED_WINDOW_SCRIPT,
+        limiter.TOKEN_BUCKET_SCRIPT,
+        limiter.GCRA_SCRIPT,
+        limiter.SLIDING_COUNTER_SCRIPT,
+    ):
+        script.registered_client = client
+    algorithms["fixed_window"] = lambda uid: limiter.is_rate_limited_fixed_window(uid, limit, window)
+    algorithms["sliding_log"] = lambda uid: limiter.is_rate_limited_sliding_window(uid, limit, window)
+    algorithms["sliding_counter"] = lambda uid: limiter.is_rate_limited_sliding_counter(
+        uid, limit, window
+    )
+    algorithms["token_bucket"] = lambda uid: limiter.is_rate_limited_token_bucket(
+        uid, capacity=limit, refill_rate=limit / window
+    )
+    algorithms["gcra"] = lambda uid: limiter.is_rate_limited_gcra(uid, limit, window)
+
+    if os.path.isdir(DESIGN_APP_DIR):
+        sys.path.insert(0, DESIGN_APP_DIR)
+        design = _load_module("rate_limiter_design_main", os.path.join(DESIGN_APP_DIR, "main.py"))
+        design.shard_router = design.ShardRouter.single(client)
+        design.RATE_LIMIT = limit
+        design.WINDOW_SECONDS = window
+        algorithms["design_sliding_log"] = lambda uid: not design.check_rate_limit(uid)[0]
+
+    return algorithms
+
+
+def clear_keys(client):
+    keys = list(client.scan_iter("rate_limit:*", count=1000))
+    for i in range(0, len(keys), 1000):
+        client.delete(*keys[i : i + 1000])
+
+
+def memory_per_key(client):
+    """Mean MEMORY USAGE and DUMP size over a sample of the limiter's keys."""
+    keys = list(client.scan_iter("rate_limit:*", count=1000))[:MEMORY_SAMPLE_KEYS]
+    if not keys:
+        return None, None
+    try:
+        usage = sum(client.memory_usage(k) or 0 for k in keys) / len(keys)
+    except redis.ResponseError:
+        # fakeredis は MEMORY USAGE に対応していない
+        usage = None
+    serialized = sum(len(client.dump(k) or b"") for k in keys) / len(keys)
+    return usage, serialized
+
+
+def _schedule(pattern, thread_rate, burst_size, keys, rng):
+    """Yield (send_at offset in seconds, key) for one worker thread, forever."""
+    gap = 1 / thread_rate if thread_rate else 0
+    t = 0.0
+    while True:
+        if pattern == "burst":
+            # 1つのキーに burst_size 件を連続で送り、その分まとめて間を空ける
+            key = f"client{rng.randrange(keys)}"
+            for _ in range(burst_size):
+                yield t, key
+            t += gap * burst_size
+        else:
+            yield t, f"client{rng.randrange(keys)}"
+            t += gap
+
+
+def run_algorithm(check, args, seed):
+    """Drive one limiter from args.threads threads and collect every decision."""
+    thread_rate = args.offered_rate / args.threads if args.pattern != "flood" else 0
+    decisions = [[] for _ in range(args.threads)]
+    errors = [0]
+    start = time.perf_counter() + 0.05
+    deadline = start + args.duration
+
+    def worker(i):
+        rng = random.Random(seed + i)
+        out = decisions[i]
+        for offset, key in _schedule(args.pattern, thread_rate, args.burst_size, args.keys, rng):
+            send_at = start + offset
+            now = time.perf_counter()
+            if send_at >= deadline or now >= deadline:
+                return
+            if send_at > now:
+                time.sleep(send_at - now)
+            t0 = time.perf_counter()
+            try:
+                limited = check(key)
+            except redis.RedisError:
+                errors[0] += 1
+                continue
+            t1 = time.perf_counter()
+            out.append((key, t0 - start, t1 - t0, not limited))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return [d for per_thread in decisions for d in per_thread], elapsed, errors[0]
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def admission_deviation(decisions, limit, window, duration):
+    """
+    上限からのずれを2つの指標で返す
+
+    peak_window_ratio: 任意の長さ window の区間で1キーが許可された最大件数 / limit
+                       (1を超えると上限を超えて許可している)
+    rate_error:        キーごとの (許可数 - min(送信数, limit × duration / window)) を
+                       許容量で割った平均 (正なら許可しすぎ、負なら拒否しすぎ)
+    """
+    allowed_at, offered = {}, {}
+    for key, t, _, allowed in decisions:
+        offered[key] = offered.get(key, 0) + 1
+        if allowed:
+            allowed_at.setdefault(key, []).append(t)
+    if not offered:
+        return {"peak_window_ratio": 0.0, "rate_error": 0.0}
+
+    peak = 0
+    for times in allowed_at.values():
+        times.sort()
+        for i, t in enumerate(times):
+            peak = max(peak, bisect_right(times, t + window - 1e-9) - i)
+
+    budget = limit * duration / window
+    errors = [
+        (len(allowed_at.get(key, ())) - min(count, budget)) / budget for key, count in offered.items()
+    ]
+    return {
+        "peak_window_ratio": round(peak / limit, 3),
+        "rate_error": round(sum(errors) / len(errors), 4),
+    }
+
+
+def benchmark(name, check, client, args, seed):
+    clear_keys(client)
+    decisions, elapsed, errors = run_algorithm(check, args, seed)
+    latencies = sorted(d[2] for d in decisions)
+    usage, serialized = memory_per_key(client)
+    return {
+        "algorithm": name,
+        "decisions": len(decisions),
+        "admitted": sum(1 for d in decisions if d[3]),
+        "errors": errors,
+        "decisions_per_sec": round(len(decisions) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(_percentile(latencies, 0.50) * 1000, 3),
+            "p99": round(_percentile(latencies, 0.99) * 1000, 3),
+        },
+        "memory_usage_per_key": round(usage, 1) if usage is not None else None,
+        "serialized_bytes_per_key": round(serialized, 1) if serialized is not None else None,
+        **admission_deviation(decisions, args.limit, args.window, args.duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--algorithms", default="all", help="comma-separated names or 'all'")
+    parser.add_argument("--redis-url", help="use this Redis instead of fakeredis")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent client threads")
+    parser.add_argument("--keys", type=int, default=50, help="number of distinct client keys")
+    parser.add_argument("--pattern", choices=PATTERNS, default="steady")
+    parser.add_argument(
+        "--offered-rate", type=float, default=2000, help="total requests/sec (ignored by flood)"
+    )
+    parser.add_argument("--burst-size", type=int, default=20, help="requests per burst (burst pattern)")
+    parser.add_argument("--limit", type=int, default=10, help="requests allowed per window and key")
+    parser.add_argument("--window", type=int, default=1, help="window in seconds")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per algorithm")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    client = make_client(args.redis_url)
+    algorithms = load_algorithms(client, args.limit, args.window)
+    names = list(algorithms) if args.algorithms == "all" else args.algorithms.split(",")
+    unknown = [n for n in names if n not in algorithms]
+    if unknown:
+        parser.error(f"unknown algorithm(s) {unknown}; choose from {list(algorithms)}")
+
+    results = [benchmark(name, algorithms[name], client, args, args.seed) for name in names]
+    clear_keys(client)
+    print(json.dumps({"config": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import redis
+import random
 import threading
 import time
+import zlib
 from flask import Flask, request, jsonify
 import os
 
@@ -13,113 +15,505 @@ redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=Tr
 
 STREAM_KEY = "line_stream"
 GROUP_NAME = "line_consumers"
-MAXLEN = 1000  # Stream capacity limit
+MAXLEN = 1000  # Stream capacity limit (per partition)
+# Messages are hashed by key onto PARTITIONS streams: line_stream:0 .. line_stream:N-1
+PARTITIONS = int(os.environ.get("PARTITIONS", 4))
+PARTITION_KEYS = [f"{STREAM_KEY}:{p}" for p in range(PARTITIONS)]
+# Consumers that have not called /consume within this window lose their partitions
+CONSUMER_SESSION_MS = int(os.environ.get("CONSUMER_SESSION_MS", 30000))
+MEMBERS_KEY = f"{STREAM_KEY}:members"
+# How long a processed message ID is remembered for deduplication
+DEDUP_TTL_SECONDS = int(os.environ.get("DEDUP_TTL_SECONDS", 3600))
+# Failover: messages pending longer than this are reclaimed from their consumer
+RECLAIM_MIN_IDLE_MS = int(os.environ.get("RECLAIM_MIN_IDLE_MS", 10000))
+RECLAIM_BATCH = int(os.environ.get("RECLAIM_BATCH", 100))
+RECLAIM_INTERVAL_SECONDS = float(os.environ.get("RECLAIM_INTERVAL_SECONDS", 5))
+# Upper bound on reclaim batches per cycle, so one cycle never runs unbounded
+RECLAIM_MAX_BATCHES = 50
+# Messages delivered this many times are moved to the dead-letter stream
+MAX_DELIVERIES = int(os.environ.get("MAX_DELIVERIES", 5))
+DEAD_LETTER_KEY = f"{STREAM_KEY}:dead"
 
-# Create consumer group
-try:
-    redis_client.xgroup_create(STREAM_KEY, GROUP_NAME, id="0", mkstream=True)
-except redis.exceptions.ResponseError as e:
-    if "BUSYGROUP" not in str(e):
-        raise
+# Create consumer group (one per partition stream)
+for stream_key in PARTITION_KEYS:
+    try:
+        redis_client.xgroup_create(stream_key, GROUP_NAME, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
 
-# Message deduplication (in-memory, consider persistence for production)
-processed_ids = set()
+# Take, renew or hand over the partition leases of one consumer in one call.
+# KEYS: lease key of every partition; ARGV[1]=consumer, ARGV[2]=lease ms,
+# ARGV[i + 2]="1" if partition i is assigned to the consumer.
+# Returns per partition: 0 not held, 1 held (renewed), 2 newly acquired.
+# A partition only changes hands after its old owner releases it or its
+# lease expires, so two consumers never read the same partition at once.
+LEASE_SCRIPT = redis_client.register_script(
+    """
+local result = {}
+for i = 1, #KEYS do
+    local owner = redis.call('GET', KEYS[i])
+    result[i] = 0
+    if ARGV[i + 2] == '1' then
+        if owner == ARGV[1] then
+            redis.call('PEXPIRE', KEYS[i], ARGV[2])
+            result[i] = 1
+        elseif not owner then
+            redis.call('SET', KEYS[i], ARGV[1], 'PX', ARGV[2])
+            result[i] = 2
+        end
+    elseif owner == ARGV[1] then
+        redis.call('DEL', KEYS[i])
+    end
+end
+return result
+"""
+)
+
+
+def dedup_key(stream, msg_id):
+    return f"{stream}:processed:{msg_id}"
+
+
+def lease_key(stream):
+    return f"{stream}:owner"
+
+
+def partition_for(key):
+    """Stable partition of a message key (crc32, same on every instance)."""
+    return zlib.crc32(key.encode("utf-8")) % PARTITIONS
 
 
 @app.route("/produce", methods=["POST"])
 def produce():
-    """Produce a message to the stream."""
+    """Produce a message to the partition of its key."""
     message = request.json.get("message")
+    key = request.json.get("key")
+    if key is not None and not isinstance(key, str):
+        return jsonify({"error": "key must be a string"}), 400
+    # Messages with the same key share a partition and keep their order;
+    # messages without a key are spread randomly
+    partition = partition_for(key) if key else random.randrange(PARTITIONS)
+    fields = {"message": message}
+    if key:
+        fields["key"] = key
     # Trim stream to limit capacity
     msg_id = redis_client.xadd(
-        STREAM_KEY, {"message": message}, maxlen=MAXLEN, approximate=True
+        PARTITION_KEYS[partition], fields, maxlen=MAXLEN, approximate=True
+    )
+    return jsonify({"id": msg_id, "partition": partition})
+
+
+def live_members(consumer=None):
+    """Heartbeat consumer (if given) and return the live members, sorted."""
+    now = int(time.time() * 1000)
+    pipe = redis_client.pipeline(transaction=False)
+    if consumer:
+        pipe.zadd(MEMBERS_KEY, {consumer: now})
+    pipe.zremrangebyscore(MEMBERS_KEY, "-inf", now - CONSUMER_SESSION_MS)
+    pipe.zrange(MEMBERS_KEY, 0, -1)
+    return sorted(pipe.execute()[-1])
+
+
+def assigned_partitions(consumer, members):
+    """Round-robin assignment: partition p goes to members[p % len(members)]."""
+    if consumer not in members:
+        return []
+    return [p for p in range(PARTITIONS) if members[p % len(members)] == consumer]
+
+
+def acquire_partitions(consumer):
+    """Rebalance for consumer and return the partition streams it now owns.
+
+    Every instance computes the same assignment from the live members, and
+    leases make a partition move only once its previous owner let go of it.
+    """
+    assigned = set(assigned_partitions(consumer, live_members(consumer)))
+    states = LEASE_SCRIPT(
+        keys=[lease_key(s) for s in PARTITION_KEYS],
+        args=[consumer, CONSUMER_SESSION_MS] + ["1" if p in assigned else "0" for p in range(PARTITIONS)],
     )
-    return jsonify({"id": msg_id})
+    owned = []
+    for stream, state in zip(PARTITION_KEYS, states):
+        if state:
+            owned.append(stream)
+    return owned
+
+
+def consumer_arg():
+    """The consumer name from the JSON body, or None if missing."""
+    consumer = (request.get_json(silent=True) or {}).get("consumer")
+    return consumer if isinstance(consumer, str) and consumer else None
+
+
+def missing_consumer():
+    return jsonify({"error": "consumer is required"}), 400
+
+
+def unprocessed(stream, messages):
+    """Drop messages already processed, acking them (and trimmed entries) in one XACK.
+
+    The dedup store is only written by /ack, so a message delivered again
+    after its consumer processed it but before the XACK landed is skipped here.
+    """
+    if not messages:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for msg_id, _ in messages:
+        pipe.exists(dedup_key(stream, msg_id))
+    seen = pipe.execute()
+    # Entries trimmed from the stream come back without fields
+    skipped = [msg_id for (msg_id, fields), done in zip(messages, seen) if done or not fields]
+    if skipped:
+        redis_client.xack(stream, GROUP_NAME, *skipped)
+    return [
+        {
+            "id": msg_id,
+            "partition": PARTITION_KEYS.index(stream),
+            "key": fields.get("key"),
+            "message": fields["message"],
+        }
+        for (msg_id, fields), done in zip(messages, seen)
+        if not done and fields
+    ]
+
+
+def deliver(consumer, streams, count, block=None):
+    """Read a batch for consumer and drop messages that were already processed.
+
+    streams maps each owned partition stream to a start ID: ">" reads new
+    messages; "0" re-reads the consumer's own pending entries. count applies
+    per partition.
+    Delivered messages stay pending until the consumer calls /ack.
+    """
+    msgs = redis_client.xreadgroup(GROUP_NAME, consumer, streams, count=count, block=block)
+    results = []
+    for stream, messages in msgs or []:
+        results.extend(unprocessed(stream, messages))
+    return results
+
+
+def handover_key(stream, consumer):
+    """IDs the failover monitor claimed to consumer that it has not been sent yet."""
+    return f"{stream}:handover:{consumer}"
+
+
+def pending_entries(stream, idle=None):
+    """Yield every entry of the stream's PEL in ID order, RECLAIM_BATCH per XPENDING call."""
+    start = "-"
+    while True:
+        entries = redis_client.xpending_range(
+            stream, GROUP_NAME, min=start, max="+", count=RECLAIM_BATCH, idle=idle
+        )
+        yield from entries
+        if len(entries) < RECLAIM_BATCH:
+            return
+        start = "(" + entries[-1]["message_id"]
+
+
+def claim_foreign(stream, owner, count_delivery=True):
+    """XCLAIM to owner the idle entries other consumers hold in stream.
+
+    Entries of owner itself are never claimed, so its in-flight messages keep
+    their delivery count. A claim counts as a delivery unless count_delivery
+    is False (the caller re-reads them with XREADGROUP, which counts it).
+    Returns the claimed IDs and whether other consumers' entries remain.
+    """
+    foreign = [e for e in pending_entries(stream) if e["consumer"] != owner]
+    # Exhausted messages are left to the dead-letter check
+    ready = [
+        e
+        for e in foreign
+        if e["time_since_delivered"] >= RECLAIM_MIN_IDLE_MS and e["times_delivered"] < MAX_DELIVERIES
+    ]
+    if not ready:
+        return [], bool(foreign)
+    # XCLAIM re-checks the idle time, so an entry acked or claimed meanwhile is skipped
+    pipe = redis_client.pipeline(transaction=False)
+    for entry in ready:
+        pipe.xclaim(
+            stream,
+            GROUP_NAME,
+            owner,
+            RECLAIM_MIN_IDLE_MS,
+            [entry["message_id"]],
+            retrycount=entry["times_delivered"] + (1 if count_delivery else 0),
+            justid=True,
+        )
+    claimed = [msg_id for ids in pipe.execute() for msg_id in ids]
+    return claimed, len(claimed) < len(foreign)
+
+
+def _id_order(msg_id):
+    ms, seq = msg_id.split("-")
+    return int(ms), int(seq)
+
+
+def take_over(consumer, streams, count):
+    """Deliver the messages previous owners left in the consumer's partitions.
+
+    Those are the entries the failover monitor already claimed to consumer
+    (its handover set) and idle entries other consumers still hold, which are
+    claimed here. Returns the messages, oldest first and at most count per
+    partition, and the streams that must not read new messages yet because
+    older ones of the same keys are still outstanding.
+    """
+    pipe = redis_client.pipeline()
+    for stream in streams:
+        pipe.smembers(handover_key(stream, consumer))
+        pipe.delete(handover_key(stream, consumer))
+    handed = pipe.execute()[::2]
+    results, blocked = [], []
+    for stream, handed_ids in zip(streams, handed):
+        claimed, remaining = claim_foreign(stream, consumer)
+        msg_ids = sorted(set(handed_ids) | set(claimed), key=_id_order)
+        if msg_ids[count:]:
+            # The rest are already in this consumer's PEL: send them next time
+            redis_client.sadd(handover_key(stream, consumer), *msg_ids[count:])
+        if remaining or msg_ids[count:]:
+            blocked.append(stream)
+        msg_ids = msg_ids[:count]
+        if not msg_ids:
+            continue
+        pipe = redis_client.pipeline(transaction=False)
+        for msg_id in msg_ids:
+            pipe.xrange(stream, min=msg_id, max=msg_id)
+        # Entries trimmed from the stream come back without fields
+        messages = [
+            (msg_id, body[0][1] if body else {}) for msg_id, body in zip(msg_ids, pipe.execute())
+        ]
+        results.extend(unprocessed(stream, messages))
+    return results, blocked
 
 
 @app.route("/consume", methods=["POST"])
 def consume():
-    """Consume messages from the stream."""
-    consumer = request.json.get("consumer")
+    """Consume messages from the partitions assigned to this consumer."""
+    consumer = consumer_arg()
+    if consumer is None:
+        return missing_consumer()
     count = request.json.get("count", 1)
-    # Get unprocessed messages
-    msgs = redis_client.xreadgroup(
-        GROUP_NAME, consumer, {STREAM_KEY: ">"}, count=count, block=1000
+    owned = acquire_partitions(consumer)
+    if not owned:
+        return jsonify({"messages": [], "partitions": []})
+    # Messages left by previous owners first; new messages only from partitions
+    # without such a backlog (so a partition never skips ahead of it)
+    results, blocked = take_over(consumer, owned, count)
+    readable = [s for s in owned if s not in blocked]
+    if not results and readable:
+        results = deliver(consumer, {s: ">" for s in readable}, count, block=1000)
+    return jsonify(
+        {"messages": results, "partitions": [PARTITION_KEYS.index(s) for s in owned]}
+    )
+
+
+@app.route("/ack", methods=["POST"])
+def ack():
+    """Acknowledge processed messages, given as returned by /consume."""
+    by_stream = {}
+    for message in request.json.get("messages", []):
+        partition = message.get("partition") if isinstance(message, dict) else None
+        if not isinstance(partition, int) or not 0 <= partition < PARTITIONS or not message.get("id"):
+            return jsonify({"error": "each message needs an id and a valid partition"}), 400
+        by_stream.setdefault(PARTITION_KEYS[partition], []).append(message["id"])
+    if not by_stream:
+        return jsonify({"acked": 0})
+    # One round trip: mark every ID in the shared dedup store (SET NX with a
+    # TTL, so memory stays bounded and all instances see it), then one
+    # multi-ID XACK per partition
+    pipe = redis_client.pipeline(transaction=False)
+    for stream, msg_ids in by_stream.items():
+        for msg_id in msg_ids:
+            pipe.set(dedup_key(stream, msg_id), 1, nx=True, ex=DEDUP_TTL_SECONDS)
+        pipe.xack(stream, GROUP_NAME, *msg_ids)
+    try:
+        results = pipe.execute()
+    except redis.exceptions.ResponseError as e:
+        return jsonify({"error": str(e)}), 400
+    acked = 0
+    i = 0
+    for msg_ids in by_stream.values():
+        i += len(msg_ids)
+        acked += results[i]
+        i += 1
+    return jsonify({"acked": acked})
+
+
+@app.route("/leave", methods=["POST"])
+def leave():
+    """Leave the group now and hand the consumer's partitions to the others."""
+    consumer = consumer_arg()
+    if consumer is None:
+        return missing_consumer()
+    redis_client.zrem(MEMBERS_KEY, consumer)
+    LEASE_SCRIPT(
+        keys=[lease_key(s) for s in PARTITION_KEYS],
+        args=[consumer, CONSUMER_SESSION_MS] + ["0"] * PARTITIONS,
+    )
+    return jsonify({"status": "left", "consumer": consumer})
+
+
+@app.route("/partitions", methods=["GET"])
+def partitions():
+    """Live members and the current owner of every partition."""
+    members = live_members()
+    pipe = redis_client.pipeline(transaction=False)
+    for stream in PARTITION_KEYS:
+        pipe.get(lease_key(stream))
+        pipe.xlen(stream)
+    results = pipe.execute()
+    return jsonify(
+        {
+            "members": members,
+            "partitions": [
+                {"partition": p, "owner": results[p * 2], "length": results[p * 2 + 1]}
+                for p in range(PARTITIONS)
+            ],
+        }
     )
-    results = []
-    for stream, messages in msgs:
-        for msg_id, fields in messages:
-            # Deduplication
-            if msg_id in processed_ids:
-                continue
-            processed_ids.add(msg_id)
-            results.append({"id": msg_id, "message": fields["message"]})
-            # Acknowledge
-            redis_client.xack(STREAM_KEY, GROUP_NAME, msg_id)
-    return jsonify({"messages": results})
 
 
 @app.route("/pending", methods=["GET"])
 def pending():
     """Get pending messages."""
-    consumer = request.json.get("consumer")
-    # Get pending messages
-    pending = redis_client.xpending(STREAM_KEY, GROUP_NAME)
+    # Get pending messages (per partition)
+    pending = {stream: redis_client.xpending(stream, GROUP_NAME) for stream in PARTITION_KEYS}
     return jsonify({"pending": pending})
 
 
 @app.route("/replay", methods=["POST"])
 def replay():
-    """Replay pending messages."""
-    consumer = request.json.get("consumer")
-    # Redeliver pending messages
-    pending = redis_client.xpending(STREAM_KEY, GROUP_NAME)
-    results = []
-    for msg in pending["consumers"]:
-        if msg["consumer"] == consumer:
-            msg_id = msg["message_id"]
-            if msg_id not in processed_ids:
-                msg_data = redis_client.xrange(STREAM_KEY, min=msg_id, max=msg_id)
-                for mid, fields in msg_data:
-                    results.append({"id": mid, "message": fields["message"]})
-    return jsonify({"replay": results})
+    """Redeliver the pending messages of this consumer's partitions.
+
+    Idle entries of previous owners are claimed first, then the consumer's
+    whole PEL (its own unacked messages, e.g. after it restarted, plus the
+    claimed ones) is re-read once, so every message is returned once.
+    """
+    consumer = consumer_arg()
+    if consumer is None:
+        return missing_consumer()
+    count = request.json.get("count", RECLAIM_BATCH)
+    owned = acquire_partitions(consumer)
+    if not owned:
+        return jsonify({"replay": [], "claimed": 0, "dead_lettered": 0})
+    dead_lettered = sum(dead_letter_exhausted(stream) for stream in owned)
+    claimed = 0
+    for stream in owned:
+        # Re-reading from "0" counts as the delivery, so the claim itself does not
+        claimed += len(claim_foreign(stream, consumer, count_delivery=False)[0])
+        redis_client.delete(handover_key(stream, consumer))
+    messages = {}
+    for message in deliver(consumer, {s: "0" for s in owned}, count):
+        messages.setdefault((message["partition"], message["id"]), message)
+    return jsonify(
+        {
+            "replay": list(messages.values()),
+            "claimed": claimed,
+            "dead_lettered": dead_lettered,
+        }
+    )
+
+
+@app.route("/dead_letters", methods=["GET"])
+def dead_letters():
+    """List messages moved to the dead-letter stream."""
+    count = request.args.get("count", 100, type=int)
+    entries = redis_client.xrange(DEAD_LETTER_KEY, count=count)
+    return jsonify({"dead_letters": [{"id": mid, **fields} for mid, fields in entries]})
 
 
 @app.route("/trim", methods=["POST"])
 def trim():
-    """Trim the stream."""
+    """Trim every partition stream."""
     maxlen = request.json.get("maxlen", MAXLEN)
-    redis_client.xtrim(STREAM_KEY, maxlen=maxlen, approximate=True)
+    for stream in PARTITION_KEYS:
+        redis_client.xtrim(stream, maxlen=maxlen, approximate=True)
     return jsonify({"status": "trimmed", "maxlen": maxlen})
 
 
 @app.route("/group_info", methods=["GET"])
 def group_info():
     """Get consumer group info."""
-    info = redis_client.xinfo_groups(STREAM_KEY)
+    info = {stream: redis_client.xinfo_groups(stream) for stream in PARTITION_KEYS}
     return jsonify({"groups": info})
 
 
 @app.route("/health", methods=["GET"])
 def stream_info():
     """Get stream info."""
-    info = redis_client.xinfo_stream(STREAM_KEY)
-    return jsonify({"stream": info})
+    info = {stream: redis_client.xinfo_stream(stream) for stream in PARTITION_KEYS}
+    return jsonify({"streams": info})
 
 
-# Consumer failure auto-failover (simple: redeliver pending)
+def dead_letter_exhausted(stream):
+    """Move idle pending messages delivered MAX_DELIVERIES times to the dead-letter stream."""
+    moved = 0
+    start = "-"
+    for _ in range(RECLAIM_MAX_BATCHES):
+        entries = redis_client.xpending_range(
+            stream, GROUP_NAME, min=start, max="+", count=RECLAIM_BATCH, idle=RECLAIM_MIN_IDLE_MS
+        )
+        exhausted = [e for e in entries if e["times_delivered"] >= MAX_DELIVERIES]
+        if exhausted:
+            pipe = redis_client.pipeline(transaction=False)
+            for entry in exhausted:
+                pipe.xrange(stream, min=entry["message_id"], max=entry["message_id"])
+            bodies = pipe.execute()
+            pipe = redis_client.pipeline(transaction=False)
+            for entry, body in zip(exhausted, bodies):
+                # Messages already trimmed from the stream are just acked
+                if body:
+                    pipe.xadd(
+                        DEAD_LETTER_KEY,
+                        {
+                            **body[0][1],
+                            "original_id": entry["message_id"],
+                            "consumer": entry["consumer"],
+                            "deliveries": entry["times_delivered"],
+                        },
+                        maxlen=MAXLEN,
+                        approximate=True,
+                    )
+            pipe.xack(stream, GROUP_NAME, *[e["message_id"] for e in exhausted])
+            pipe.execute()
+            moved += len(exhausted)
+        if len(entries) < RECLAIM_BATCH:
+            break
+        start = "(" + entries[-1]["message_id"]
+    return moved
+
+
+# Consumer failure auto-failover
 def failover_monitor():
-    """Monitor for failed consumers and redeliver."""
+    """Reclaim messages stuck with stalled consumers and dead-letter poison messages.
+
+    Stuck messages go to the partition's current owner, keeping each
+    partition with a single reader, and are queued in its handover set so
+    its next /consume sends them before anything newer. Unowned partitions
+    are taken over by whoever acquires them next.
+    """
     while True:
-        pending = redis_client.xpending(STREAM_KEY, GROUP_NAME)
-        for msg in pending["consumers"]:
-            if msg["pending"] > 0 and time.time() - msg["idle"] > 10:
-                # Redeliver if idle > 10s
-                msg_id = msg["message_id"]
-                msg_data = redis_client.xrange(STREAM_KEY, min=msg_id, max=msg_id)
-                for mid, fields in msg_data:
-                    print(f"Failover: {mid} -> {fields['message']}")
-        time.sleep(5)
+        try:
+            dead_lettered = claimed = 0
+            for stream in PARTITION_KEYS:
+                dead_lettered += dead_letter_exhausted(stream)
+                owner = redis_client.get(lease_key(stream))
+                if not owner:
+                    continue
+                msg_ids, _ = claim_foreign(stream, owner)
+                if msg_ids:
+                    # An owner that stops consuming loses its lease within the
+                    # session, and the new owner claims these entries again
+                    pipe = redis_client.pipeline(transaction=False)
+                    pipe.sadd(handover_key(stream, owner), *msg_ids)
+                    pipe.pexpire(handover_key(stream, owner), CONSUMER_SESSION_MS)
+                    pipe.execute()
+                    claimed += len(msg_ids)
+            if claimed or dead_lettered:
+                print(f"Failover: reclaimed {claimed}, dead-lettered {dead_lettered}")
+        except redis.exceptions.RedisError as e:
+            print(f"Failover error: {e}")
+        time.sleep(RECLAIM_INTERVAL_SECONDS)
 
 
 threading.Thread(target=failover_monitor, daemon=True).start()
@@ -0,0 +1,223 @@
+import math
+import threading
+import time
+import uuid
+
+import redis
+
+from fallback import call_with_breaker
+
+# 同時実行数のセマフォを取る (クライアントごと・ルートごとを1回のEVALSHAで)
+# KEYS[i]  : セマフォのZSET {リースID: 期限 (ミリ秒)}
+# ARGV     : lease_id, lease_ms, limit_1, limit_2, ...
+# 戻り値   : 0なら取得、それ以外は上限に達したセマフォの番号 (どのセマフォも取らない)
+# 期限切れのリース (落ちたワーカーが返さなかった分) は取得時に掃除する
+ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+for i = 1, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+    if redis.call('ZCARD', KEYS[i]) >= tonumber(ARGV[i + 2]) then
+        return i
+    end
+end
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], now + tonumber(ARGV[2]), ARGV[1])
+    redis.call('PEXPIRE', KEYS[i], ARGV[2])
+end
+return 0
+"""
+
+
+class AIMDLimit:
+    """
+    ハンドラのレイテンシで上限を調整する同時実行数 (AIMD)
+
+    レイテンシが目標以下なら上限あたり1件ずつ (1往復あたり+1相当) 増やし、
+    目標を超えたりエラーになったりしたら backoff 倍に減らす。
+    """
+
+    def __init__(self, initial, min_limit, max_limit, target_latency_ms, backoff=0.9):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency_ms / 1000
+        self.backoff = backoff
+        self._limit = float(initial)
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return int(self._limit)
+
+    def on_sample(self, latency, failed=False):
+        with self._lock:
+            if failed or latency > self.target_latency:
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+
+class Lease:
+    """One in-flight request holding concurrency slots."""
+
+    __slots__ = ("granted", "tripped", "held", "lease_id", "local_keys", "route", "started")
+
+    def __init__(self, granted, tripped=None, held=(), lease_id=None, local_keys=(), route=None):
+        self.granted = granted
+        # 上限に達した次元 ("client" / "route")
+        self.tripped = tripped
+        # 取ったセマフォ: [(shard, [key, ...]), ...]
+        self.held = held
+        self.lease_id = lease_id
+        # Redisが使えない間にプロセス内で取ったスロット
+        self.local_keys = local_keys
+        self.route = route
+        self.started = time.monotonic()
+
+
+class ConcurrencyLimiter:
+    """
+    クライアントごと・ルートごとの同時実行数 (処理中のリクエスト数) の上限
+
+    セマフォはリース期限付きのZSETで、リクエストの終了時に返却する。ワーカーが落ちて
+    返却されなかったリースも lease_seconds 後には数えなくなる。
+    クライアントのセマフォはクライアントのシャード、ルートのセマフォはルートのシャードに置き、
+    上限はそのまま使う。2つが別のシャードになる場合は2回スクリプトを呼び、ルート側で
+    上限に達したらクライアント側で取ったスロットを返す。
+    各シャードの呼び出しはそのシャードのサーキットブレーカーを通す。
+    adaptive を渡すと、ルートごとの上限をレイテンシに応じてAIMDで調整する。
+    """
+
+    def __init__(
+        self,
+        router,
+        per_client,
+        per_route,
+        lease_seconds=30,
+        workers=1,
+        adaptive=None,
+        breakers=None,
+    ):
+        self.router = router
+        self.per_client = per_client
+        self.per_route = per_route
+        self.lease_ms = int(lease_seconds * 1000)
+        self.workers = max(1, workers)
+        # adaptive: 新しいルートのAIMDLimitを作る関数
+        self.adaptive = adaptive
+        # シャード名 -> CircuitBreaker
+        self.breakers = breakers or {}
+        self.stats = {"acquired": 0, "rejected": 0, "local_acquired": 0}
+        self._route_limits = {}
+        self._local = {}
+        self._lock = threading.Lock()
+        self._script = router.shards[0].client.register_script(ACQUIRE_SCRIPT)
+
+    def route_limit(self, route):
+        if self.adaptive is None:
+            return self.per_route
+        with self._lock:
+            limit = self._route_limits.get(route)
+            if limit is None:
+                limit = self._route_limits[route] = self.adaptive()
+        return limit.value
+
+    def _limits(self, client_id, route):
+        """(dimension, shard id, key suffix, limit) of every enabled semaphore."""
+        limits = []
+        if self.per_client > 0:
+            limits.append(("client", client_id, f"{client_id}:inflight", self.per_client))
+        if self.per_route > 0:
+            limits.append(("route", route, f"inflight:route:{route}", self.route_limit(route)))
+        return limits
+
+    def acquire(self, client_id, route):
+        """
+        リクエストの開始時にスロットを取る
+
+        Returns:
+            Lease: granted が False なら上限に達している
+
+        Raises:
+            ShardUnavailable: セマフォを置くシャードのブレーカーが開いている場合
+            redis.RedisError: Redisへの問い合わせに失敗した場合
+        """
+        # シャードごとにまとめる (同じシャードなら1回の呼び出しで両方取る)
+        groups = {}
+        for name, shard_id, suffix, limit in self._limits(client_id, route):
+            groups.setdefault(self.router.shard_for(shard_id), []).append((name, suffix, limit))
+        lease_id = uuid.uuid4().hex
+        held = []
+        try:
+            for shard, limits in groups.items():
+                keys = [shard.key(suffix) for _, suffix, _ in limits]
+                tripped = call_with_breaker(
+                    self.breakers.get(shard.name),
+                    shard,
+                    self._script,
+                    keys=keys,
+                    args=[lease_id, self.lease_ms] + [limit for _, _, limit in limits],
+                    client=shard.client,
+                )
+                if tripped:
+                    # 先に取った別シャードのスロットを返す
+                    self._release_redis(held, lease_id)
+                    self.stats["rejected"] += 1
+                    return Lease(False, tripped=limits[tripped - 1][0], route=route)
+                held.append((shard, keys))
+        except Exception:
+            # 途中のシャードが失敗した時も先に取ったスロットを返す (返せなければリース期限で消える)
+            try:
+                self._release_redis(held, lease_id)
+            except redis.RedisError:
+                pass
+            raise
+        self.stats["acquired"] += 1
+        return Lease(True, held=held, lease_id=lease_id, route=route)
+
+    def acquire_local(self, client_id, route):
+        """Redisが使えない間の近似: プロセス内で数え、上限は想定ワーカー数で割る"""
+        limits = [
+            (name, suffix, max(1, math.ceil(limit / self.workers)))
+            for name, _, suffix, limit in self._limits(client_id, route)
+        ]
+        with self._lock:
+            for name, suffix, limit in limits:
+                if self._local.get(suffix, 0) >= limit:
+                    self.stats["rejected"] += 1
+                    return Lease(False, tripped=name, route=route)
+            for _, suffix, _ in limits:
+                self._local[suffix] = self._local.get(suffix, 0) + 1
+            self.stats["local_acquired"] += 1
+        return Lease(True, local_keys=[suffix for _, suffix, _ in limits], route=route)
+
+    def release(self, lease, failed=False):
+        """
+        リクエストの終了時にスロットを返却し、レイテンシを上限の調整に使う
+
+        Raises:
+            redis.RedisError: 返却に失敗した場合 (リースは期限切れで自然に解放される)
+        """
+        if not lease.granted:
+            return
+        if self.adaptive is not None and self.per_route > 0:
+            with self._lock:
+                limit = self._route_limits.get(lease.route)
+            if limit is not None:
+                limit.on_sample(time.monotonic() - lease.started, failed)
+        if lease.local_keys:
+            with self._lock:
+                for suffix in lease.local_keys:
+                    self._local[suffix] -= 1
+                    if self._local[suffix] <= 0:
+                        del self._local[suffix]
+            return
+        self._release_redis(lease.held, lease.lease_id)
+
+    @staticmethod
+    def _release_redis(held, lease_id):
+        for shard, keys in held:
+            with shard.client.pipeline() as pipe:
+                for key in keys:
+                    pipe.zrem(key, lease_id)
+                pipe.execute()
@@ -0,0 +1,140 @@
+import math
+import threading
+import time
+
+import redis
+
+
+class CircuitBreaker:
+    """
+    Redisへの呼び出しを守るサーキットブレーカー
+
+    closed   : 通常どおりRedisを使う。連続 failure_threshold 回失敗したら open にする
+    open     : Redisを呼ばずに即座にフォールバックする。reset_timeout 秒後に half_open にする
+    half_open: 1リクエストだけRedisを試し、成功すれば closed、失敗すれば再び open にする
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.stats = {"opens": 0, "rejected_calls": 0}
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if the caller may try Redis now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                # 復旧確認は1リクエストだけに任せる
+                self._probing = True
+                return True
+            self.stats["rejected_calls"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_skipped(self):
+        """The allowed call was answered without Redis: counts as neither success nor failure."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats["opens"] += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class ShardUnavailable(redis.RedisError):
+    """The circuit breaker of a shard the request needs is open."""
+
+
+def call_with_breaker(breaker, shard, func, *args, **kwargs):
+    """Call func for one shard through that shard's breaker (None: always call)."""
+    if breaker is not None and not breaker.allow():
+        raise ShardUnavailable(f"Circuit breaker open for shard {shard.name}")
+    try:
+        result = func(*args, **kwargs)
+    except redis.RedisError:
+        if breaker is not None:
+            breaker.record_failure()
+        raise
+    except Exception:
+        if breaker is not None:
+            breaker.record_skipped()
+        raise
+    if breaker is not None:
+        breaker.record_success()
+    return result
+
+
+class LocalRateLimiter:
+    """
+    Redisが使えない間だけ使うプロセス内の近似リミッター (スライディングウィンドウカウンタ)
+
+    各プロセスが独立に数えるので、上限は全体の上限を想定ワーカー数で割った値にする。
+    クライアントごとに直前と現在のウィンドウの件数だけを持つ。
+    """
+
+    def __init__(self, limit, window_seconds, workers=1, max_clients=100_000):
+        self.limit = max(1, math.ceil(limit / max(1, workers)))
+        self.window_seconds = window_seconds
+        self.max_clients = max_clients
+        self.stats = {"decisions": 0}
+        # client_id -> [window_id, current_count, previous_count]
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def check(self, client_id):
+        """
+        Returns:
+            tuple: (is_allowed, remaining, reset_time)
+        """
+        now = time.time()
+        window_id = int(now // self.window_seconds)
+        elapsed = (now % self.window_seconds) / self.window_seconds
+        reset_time = (window_id + 1) * self.window_seconds
+        with self._lock:
+            self.stats["decisions"] += 1
+            counter = self._counters.get(client_id)
+            if counter is None:
+                if len(self._counters) >= self.max_clients:
+                    self._prune(window_id)
+                counter = self._counters[client_id] = [window_id, 0, 0]
+            elif counter[0] != window_id:
+                # ウィンドウが1つ進んだなら現在の件数が直前の件数になる
+                previous = counter[1] if counter[0] == window_id - 1 else 0
+                counter[:] = [window_id, 0, previous]
+            estimate = counter[2] * (1 - elapsed) + counter[1]
+            if estimate + 1 > self.limit:
+                return False, 0, reset_time
+            counter[1] += 1
+            return True, int(self.limit - estimate - 1), reset_time
+
+    def _prune(self, window_id):
+        """Drop clients idle for two windows. Must be called with _lock held."""
+        for client_id in [c for c, v in self._counters.items() if v[0] < window_id - 1]:
+            del self._counters[client_id]
+        if len(self._counters) >= self.max_clients:
+            # それでも多すぎる場合は全て捨てる (近似なので許容する)
+            self._counters.clear()
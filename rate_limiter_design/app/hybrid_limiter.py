@@ -0,0 +1,225 @@
+import math
+import threading
+import time
+
+import redis
+
+
+class _LocalBucket:
+    """Tokens this process has reserved for one client in one window."""
+
+    __slots__ = ("window_id", "tokens", "total", "spent", "denied", "exhausted")
+
+    def __init__(self, window_id):
+        self.window_id = window_id
+        # Redisから予約済みで、まだ使っていないトークン
+        self.tokens = 0
+        # 最後に見た全プロセス合計の予約数
+        self.total = 0
+        # 前回の同期以降にこのプロセスが許可した件数
+        self.spent = 0
+        # 前回の同期以降に予算切れとして拒否した件数
+        self.denied = 0
+        # ウィンドウの予算を使い切った (次の同期まではRedisに問い合わせずに拒否する)
+        self.exhausted = False
+
+
+class HybridRateLimiter:
+    """
+    ローカルのトークンバケットとRedisの全体予算を組み合わせたレートリミッター
+
+    Redisの `rate_limit:{client_id}:hybrid:{window_id}` (クライアントのシャード上) はウィンドウ内で全プロセスが予約した
+    トークン数の合計。各プロセスは残り予算 (limit - 合計) を想定ワーカー数で割った分を
+    INCRBYでまとめて予約し、手元にトークンがある間はRedisに問い合わせずに許可する。
+    予約した分しか許可しないので、全体の許可数は limit を超えない。
+
+    バックグラウンドの同期は sync_interval_ms ごと、または前回の同期から sync_requests 件
+    許可したクライアントがある時に動き、1回のパイプラインで
+      - 残りが少ないクライアントのトークンを先に予約し直す
+      - 同期間隔の間に使われなかったトークンを返却する (DECRBY)
+    を行う (シャードごとに1往復)。使われない予約で他のプロセスが拒否される誤差は、
+    この同期間隔の分に限られる。
+    """
+
+    def __init__(
+        self,
+        router,
+        limit,
+        window_seconds,
+        workers=1,
+        sync_interval_ms=100,
+        sync_requests=10,
+        logger=None,
+        breakers=None,
+    ):
+        self.router = router
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.workers = max(1, workers)
+        self.sync_interval = sync_interval_ms / 1000
+        self.sync_requests = sync_requests
+        self.logger = logger
+        # シャード名 -> CircuitBreaker。開いているシャードにはバックグラウンド同期をしない
+        self.breakers = breakers or {}
+        self.stats = {
+            "local_decisions": 0,
+            "inline_syncs": 0,
+            "background_syncs": 0,
+            "sync_errors": 0,
+        }
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    def _key(self, client_id, window_id):
+        return self.router.shard_for(client_id).key(f"{client_id}:hybrid:{window_id}")
+
+    def _bucket(self, client_id, window_id):
+        """Return the client's bucket for this window. Must be called with _lock held."""
+        bucket = self._buckets.get(client_id)
+        if bucket is None or bucket.window_id != window_id:
+            bucket = _LocalBucket(window_id)
+            self._buckets[client_id] = bucket
+        return bucket
+
+    def _lease_size(self, bucket):
+        # 残り予算のうちこのプロセスの取り分
+        return max(1, math.ceil((self.limit - bucket.total) / self.workers))
+
+    def _take(self, bucket):
+        """Spend one local token. Must be called with _lock held."""
+        if bucket.tokens <= 0:
+            return False
+        bucket.tokens -= 1
+        bucket.spent += 1
+        if bucket.spent >= self.sync_requests:
+            self._wake.set()
+        return True
+
+    def _remaining(self, bucket):
+        return max(0, self.limit - bucket.total) + bucket.tokens
+
+    def check(self, client_id):
+        """
+        レート制限をチェック
+
+        Returns:
+            tuple: (is_allowed, remaining, reset_time, contacted_redis)
+
+        Raises:
+            redis.RedisError: その場での予約に失敗した場合
+        """
+        now = time.time()
+        window_id = int(now // self.window_seconds)
+        reset_time = (window_id + 1) * self.window_seconds
+
+        with self._lock:
+            bucket = self._bucket(client_id, window_id)
+            if self._take(bucket):
+                self.stats["local_decisions"] += 1
+                return True, self._remaining(bucket), reset_time, False
+            if bucket.exhausted:
+                self.stats["local_decisions"] += 1
+                bucket.denied += 1
+                return False, 0, reset_time, False
+
+        # 手元のトークンがないので、その場で予約する (1往復)
+        # Redisエラーは呼び出し側 (サーキットブレーカー) に任せる
+        try:
+            shard = self.router.shard_for(client_id)
+            self._reserve(shard.client, [(client_id, bucket, self._lease_size(bucket))])
+        except redis.RedisError:
+            self.stats["sync_errors"] += 1
+            raise
+        with self._lock:
+            self.stats["inline_syncs"] += 1
+            allowed = self._take(bucket)
+            return allowed, self._remaining(bucket), reset_time, True
+
+    def _reserve(self, client, reservations, releases=()):
+        """Reserve and release tokens for several clients of one shard in one pipeline."""
+        with client.pipeline() as pipe:
+            for client_id, bucket, count in reservations:
+                key = self._key(client_id, bucket.window_id)
+                pipe.incrby(key, count)
+                pipe.expire(key, self.window_seconds * 2)
+            for client_id, bucket, count in releases:
+                pipe.decrby(self._key(client_id, bucket.window_id), count)
+            results = pipe.execute()
+
+        overshoot = []
+        with self._lock:
+            for (client_id, bucket, count), total in zip(reservations, results[::2]):
+                # 上限を超えた分は予約できなかったものとして扱い、カウンタからも戻す
+                granted = max(0, min(count, self.limit - (total - count)))
+                if granted < count:
+                    overshoot.append((self._key(client_id, bucket.window_id), count - granted))
+                bucket.tokens += granted
+                bucket.total = min(total, self.limit)
+                bucket.exhausted = total >= self.limit
+            for (_, bucket, _), total in zip(releases, results[len(reservations) * 2 :]):
+                bucket.total = total
+        if overshoot:
+            with client.pipeline() as pipe:
+                for key, count in overshoot:
+                    pipe.decrby(key, count)
+                pipe.execute()
+
+    def sync(self):
+        """Top up busy clients and return unused tokens of idle ones, one round trip per shard."""
+        reservations, releases = {}, {}
+        with self._lock:
+            window_id = int(time.time() // self.window_seconds)
+            for client_id, bucket in list(self._buckets.items()):
+                if bucket.window_id != window_id:
+                    # 終わったウィンドウの予約はキーごと失効するので返却不要
+                    del self._buckets[client_id]
+                    continue
+                lease = self._lease_size(bucket)
+                shard = self.router.shard_for(client_id)
+                if bucket.spent == 0 and bucket.tokens > 0:
+                    releases.setdefault(shard, []).append((client_id, bucket, bucket.tokens))
+                    bucket.tokens = 0
+                elif bucket.spent and not bucket.exhausted and bucket.tokens <= lease // 2:
+                    reservations.setdefault(shard, []).append((client_id, bucket, lease))
+                elif bucket.denied:
+                    # 他のプロセスが返却した分がないか確かめる
+                    reservations.setdefault(shard, []).append((client_id, bucket, lease))
+                bucket.spent = 0
+                bucket.denied = 0
+        for shard in set(reservations) | set(releases):
+            shard_releases = releases.get(shard, [])
+            breaker = self.breakers.get(shard.name)
+            if breaker is not None and not breaker.allow():
+                # ブレーカーが開いている間は同期しない (返却予定のトークンは手元に戻す)
+                self._restore(shard_releases)
+                continue
+            try:
+                self._reserve(shard.client, reservations.get(shard, []), shard_releases)
+                self.stats["background_syncs"] += 1
+                if breaker is not None:
+                    breaker.record_success()
+            except redis.RedisError as e:
+                if breaker is not None:
+                    breaker.record_failure()
+                self._restore(shard_releases)
+                with self._lock:
+                    self.stats["sync_errors"] += 1
+                if self.logger:
+                    self.logger.error(f"Redis error during limiter sync: {e}")
+
+    def _restore(self, releases):
+        with self._lock:
+            for _, bucket, count in releases:
+                bucket.tokens += count
+
+    def reset(self, client_id):
+        with self._lock:
+            self._buckets.pop(client_id, None)
+
+    def _sync_loop(self):
+        while True:
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+            self.sync()
@@ -1,7 +1,16 @@
+import json
 import os
 import time
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from concurrency import AIMDLimit, ConcurrencyLimiter
+from fallback import CircuitBreaker, LocalRateLimiter, ShardUnavailable
+from hybrid_limiter import HybridRateLimiter
+from rules import RuleEngine, load_rules
+from sharding import ShardRouter
 
 app = Flask(__name__)
 
@@ -11,12 +20,137 @@ REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 RATE_LIMIT = int(os.getenv("RATE_LIMIT", 5))
 WINDOW_SECONDS = int(os.getenv("WINDOW_SECONDS", 60))
 
+# sliding_log: リクエストごとにRedisのZSETで判定
+# hybrid: プロセス内のトークンバケットで判定し、Redisとは非同期に同期する
+# rules: 宣言的に定義した複数のルール (IP / APIキー / ルート / 全体) を1回のLuaで判定する
+LIMITER_MODE = os.getenv("LIMITER_MODE", "sliding_log")
+HYBRID_SYNC_INTERVAL_MS = int(os.getenv("HYBRID_SYNC_INTERVAL_MS", 100))
+HYBRID_SYNC_REQUESTS = int(os.getenv("HYBRID_SYNC_REQUESTS", 10))
+# 想定するプロセス数 (gunicornのワーカー数 × インスタンス数)
+EXPECTED_WORKERS = int(os.getenv("EXPECTED_WORKERS", 1))
+# 全体予算を分け合うプロセス数 (未指定なら EXPECTED_WORKERS)
+HYBRID_WORKERS = int(os.getenv("HYBRID_WORKERS", EXPECTED_WORKERS))
+# ルール定義: RATE_LIMIT_RULES (JSON文字列) があれば優先し、なければファイルから読む
+RATE_LIMIT_RULES = os.getenv("RATE_LIMIT_RULES")
+RATE_LIMIT_RULES_FILE = os.getenv("RATE_LIMIT_RULES_FILE", "rate_limit_rules.json")
+API_KEY_HEADER = os.getenv("API_KEY_HEADER", "X-API-Key")
+
+# シャーディング: REDIS_NODES (host:port,...) を指定するとクライアント側のコンシステントハッシュで
+# 複数のRedisに分散し、REDIS_CLUSTER=true ならRedis Clusterにハッシュタグ付きのキーで分散する
+REDIS_NODES = os.getenv("REDIS_NODES")
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
+CLUSTER_VIRTUAL_SHARDS = int(os.getenv("CLUSTER_VIRTUAL_SHARDS", 16))
+# 1クライアントのキーを同じシャードに集めるための次元 (rulesモード)
+SHARD_BY = os.getenv("SHARD_BY", "ip")
+
+# Redisが遅い・落ちている時に判定が待たされないよう、タイムアウトは短くする
+REDIS_SOCKET_TIMEOUT_MS = int(os.getenv("REDIS_SOCKET_TIMEOUT_MS", 50))
+REDIS_CONNECT_TIMEOUT_MS = int(os.getenv("REDIS_CONNECT_TIMEOUT_MS", 50))
+# 連続 BREAKER_FAILURE_THRESHOLD 回失敗したらブレーカーを開き、
+# BREAKER_RESET_TIMEOUT_SECONDS 秒の間はプロセス内の近似リミッターで判定する
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT_SECONDS = float(os.getenv("BREAKER_RESET_TIMEOUT_SECONDS", 5))
+
+# 同時実行数 (処理中のリクエスト数) の上限。0なら無効
+CONCURRENCY_PER_CLIENT = int(os.getenv("CONCURRENCY_PER_CLIENT", 0))
+CONCURRENCY_PER_ROUTE = int(os.getenv("CONCURRENCY_PER_ROUTE", 0))
+# 返却されなかったリース (落ちたワーカーの分) を数えなくなるまでの秒数
+CONCURRENCY_LEASE_SECONDS = float(os.getenv("CONCURRENCY_LEASE_SECONDS", 30))
+# true ならルートごとの上限をハンドラのレイテンシでAIMD調整する (CONCURRENCY_PER_ROUTE が初期値)
+CONCURRENCY_ADAPTIVE = os.getenv("CONCURRENCY_ADAPTIVE", "false").lower() == "true"
+CONCURRENCY_MIN_LIMIT = int(os.getenv("CONCURRENCY_MIN_LIMIT", 1))
+CONCURRENCY_MAX_LIMIT = int(os.getenv("CONCURRENCY_MAX_LIMIT", 200))
+CONCURRENCY_TARGET_LATENCY_MS = float(os.getenv("CONCURRENCY_TARGET_LATENCY_MS", 200))
+
 
 # レート制限チェックをスキップするエンドポイント
 RATE_LIMIT_EXCLUDED_PATHS = {"/health", "/api/reset"}
 
-# Redis接続
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# Redis接続 (クライアントIDからシャードを選ぶ)
+# リトライは明示的に無効にする (redis-py 6以降は既定でバックオフ付きのリトライが入り、
+# 失敗1回に数秒かかってタイムアウトで判定時間を抑えられなくなる)
+REDIS_TIMEOUTS = {
+    "socket_timeout": REDIS_SOCKET_TIMEOUT_MS / 1000,
+    "socket_connect_timeout": REDIS_CONNECT_TIMEOUT_MS / 1000,
+    "retry": Retry(NoBackoff(), 0),
+    "retry_on_timeout": False,
+}
+if REDIS_CLUSTER:
+    shard_router = ShardRouter.for_cluster(
+        REDIS_HOST,
+        REDIS_PORT,
+        CLUSTER_VIRTUAL_SHARDS,
+        cluster_error_retry_attempts=0,
+        **REDIS_TIMEOUTS,
+    )
+elif REDIS_NODES:
+    shard_router = ShardRouter.from_nodes(REDIS_NODES, **REDIS_TIMEOUTS)
+else:
+    shard_router = ShardRouter.single(
+        redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True, **REDIS_TIMEOUTS)
+    )
+
+# シャードごとのサーキットブレーカー (1つのシャードが落ちても他のシャードはRedisで判定を続ける)
+breakers = {
+    shard.name: CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT_SECONDS)
+    for shard in shard_router.shards
+}
+# ブレーカーが開いている間に使うプロセス内の近似リミッター (IPごとに RATE_LIMIT / WINDOW_SECONDS)
+fallback_limiter = LocalRateLimiter(RATE_LIMIT, WINDOW_SECONDS, workers=EXPECTED_WORKERS)
+
+
+def make_adaptive_limit():
+    """ルートごとのAIMD上限を作る (CONCURRENCY_ADAPTIVE=true の時に使う)"""
+    return AIMDLimit(
+        CONCURRENCY_PER_ROUTE,
+        CONCURRENCY_MIN_LIMIT,
+        CONCURRENCY_MAX_LIMIT,
+        CONCURRENCY_TARGET_LATENCY_MS,
+    )
+
+
+concurrency_limiter = None
+if CONCURRENCY_PER_CLIENT > 0 or CONCURRENCY_PER_ROUTE > 0:
+    concurrency_limiter = ConcurrencyLimiter(
+        shard_router,
+        CONCURRENCY_PER_CLIENT,
+        CONCURRENCY_PER_ROUTE,
+        lease_seconds=CONCURRENCY_LEASE_SECONDS,
+        workers=EXPECTED_WORKERS,
+        adaptive=make_adaptive_limit if CONCURRENCY_ADAPTIVE else None,
+        breakers=breakers,
+    )
+
+hybrid_limiter = None
+if LIMITER_MODE == "hybrid":
+    hybrid_limiter = HybridRateLimiter(
+        shard_router,
+        RATE_LIMIT,
+        WINDOW_SECONDS,
+        workers=HYBRID_WORKERS,
+        sync_interval_ms=HYBRID_SYNC_INTERVAL_MS,
+        sync_requests=HYBRID_SYNC_REQUESTS,
+        logger=app.logger,
+        breakers=breakers,
+    )
+
+
+def load_rule_config():
+    """ルール定義を読み込む (未定義ならIPごとに RATE_LIMIT / WINDOW_SECONDS の1ルール)"""
+    if RATE_LIMIT_RULES:
+        return json.loads(RATE_LIMIT_RULES)
+    if os.path.exists(RATE_LIMIT_RULES_FILE):
+        with open(RATE_LIMIT_RULES_FILE) as f:
+            return json.load(f)
+    return [{"name": "per_ip", "by": ["ip"], "limit": RATE_LIMIT, "window": WINDOW_SECONDS}]
+
+
+# 起動時にルールをコンパイルする (定義の誤りはここで失敗させる)
+rule_engine = None
+if LIMITER_MODE == "rules":
+    rule_engine = RuleEngine(
+        shard_router, load_rules(load_rule_config()), shard_by=SHARD_BY, breakers=breakers
+    )
 
 
 def get_client_ip():
@@ -35,48 +169,125 @@ def check_rate_limit(client_ip):
 
     Returns:
         tuple: (is_allowed, remaining, reset_time)
+
+    Raises:
+        redis.RedisError: Redisへの問い合わせに失敗した場合
     """
     current_time = time.time()
     window_start_timestamp = current_time - WINDOW_SECONDS
 
-    # Redisキー: rate_limit:{client_ip}
-    key = f"rate_limit:{client_ip}"
+    # Redisキー: rate_limit:{client_ip} (クラスタでは rate_limit:{<シャードのタグ>}:{client_ip})
+    shard = shard_router.shard_for(client_ip)
+    key = shard.key(client_ip)
 
-    try:
-        with redis_client.pipeline() as pipe:
-            # 1. ウィンドウ外の古いタイムスタンプを削除
-            pipe.zremrangebyscore(key, 0, window_start_timestamp)
+    with shard.client.pipeline() as pipe:
+        # 1. ウィンドウ外の古いタイムスタンプを削除
+        pipe.zremrangebyscore(key, 0, window_start_timestamp)
 
-            # 2. 現在のリクエストのタイムスタンプを追加
-            #    ユニークなメンバーにするため、タイムスタンプとナノ秒を組み合わせる
-            pipe.zadd(key, {f"{current_time}": current_time})
+        # 2. 現在のリクエストのタイムスタンプを追加
+        #    ユニークなメンバーにするため、タイムスタンプとナノ秒を組み合わせる
+        pipe.zadd(key, {f"{current_time}": current_time})
 
-            # 3. 現在のウィンドウ内のリクエスト数を取得
-            pipe.zcard(key)
+        # 3. 現在のウィンドウ内のリクエスト数を取得
+        pipe.zcard(key)
 
-            # 4. キーにTTLを設定して自動クリーンアップ
-            pipe.expire(key, WINDOW_SECONDS)
+        # 4. キーにTTLを設定して自動クリーンアップ
+        pipe.expire(key, WINDOW_SECONDS)
 
-            # トランザクション実行
-            results = pipe.execute()
+        # トランザクション実行
+        results = pipe.execute()
 
-        current_count = results[2]
+    current_count = results[2]
 
-        # 残りリクエスト数を計算
-        remaining = max(0, RATE_LIMIT - current_count)
+    # 残りリクエスト数を計算
+    remaining = max(0, RATE_LIMIT - current_count)
 
-        # 次のリセットは常に1秒後（最も古いリクエストがウィンドウから外れるため）
-        reset_time = int(current_time + 1)
+    # 次のリセットは常に1秒後（最も古いリクエストがウィンドウから外れるため）
+    reset_time = int(current_time + 1)
 
-        # レート制限チェック
-        is_allowed = current_count <= RATE_LIMIT
+    # レート制限チェック
+    is_allowed = current_count <= RATE_LIMIT
 
-        return is_allowed, remaining, reset_time
+    return is_allowed, remaining, reset_time
 
-    except redis.RedisError as e:
-        app.logger.error(f"Redis error: {e}")
-        # Redisエラー時は通過させる（フェイルオープン）
-        return True, RATE_LIMIT, int(current_time + WINDOW_SECONDS)
+
+def request_context(client_ip):
+    """ルールの判定に使うリクエストの属性"""
+    return {
+        "ip": client_ip,
+        "api_key": request.headers.get(API_KEY_HEADER),
+        # 登録済みのURLルール (例: /users/<id>) 単位で数える
+        "route": request.url_rule.rule if request.url_rule else request.path,
+        "method": request.method,
+        "path": request.path,
+    }
+
+
+def check_rules(ctx):
+    """
+    リクエストに適用される全ルールを、ルールのあるシャードごとに1回のEVALSHAでチェック
+
+    Returns:
+        RuleDecision: 適用ルールがない場合はNone
+
+    Raises:
+        ShardUnavailable: いずれかのシャードのブレーカーが開いている場合
+        redis.RedisError: Redisへの問い合わせに失敗した場合
+    """
+    decision = rule_engine.check(ctx, time.time())
+    return decision if decision.rule is not None else None
+
+
+def decide(client_ip):
+    """
+    モードに応じたリミッターで判定する。シャードのブレーカーが開いている間や
+    Redisエラー時は、プロセス内の近似リミッターで判定する
+
+    Returns:
+        tuple: (is_allowed, remaining, reset_time, limit, rule_name)。判定不要ならNone
+    """
+    if rule_engine is not None:
+        # ルールは複数のシャードにまたがるので、ブレーカーはシャードごとに RuleEngine が使う
+        try:
+            decision = check_rules(request_context(client_ip))
+            if decision is None:
+                return None
+            # 拒否時は超過したルール、許可時は残りが最も少ないルールをヘッダに出す
+            return (
+                decision.allowed,
+                decision.remaining,
+                decision.reset_time,
+                decision.rule.limit,
+                decision.rule.name,
+            )
+        except ShardUnavailable:
+            pass
+        except redis.RedisError as e:
+            app.logger.error(f"Redis error: {e}")
+
+    breaker = breakers[shard_router.shard_for(client_ip).name]
+    if rule_engine is None and breaker.allow():
+        try:
+            # Redisに問い合わせた時だけブレーカーに成功を記録する
+            # (ローカルの判定で half_open のブレーカーを閉じないように)
+            contacted = True
+            if hybrid_limiter is not None:
+                is_allowed, remaining, reset_time, contacted = hybrid_limiter.check(client_ip)
+                result = (is_allowed, remaining, reset_time, RATE_LIMIT, None)
+            else:
+                result = (*check_rate_limit(client_ip), RATE_LIMIT, None)
+            if contacted:
+                breaker.record_success()
+            else:
+                breaker.record_skipped()
+            return result
+        except redis.RedisError as e:
+            breaker.record_failure()
+            app.logger.error(f"Redis error: {e}")
+
+    # フェイルオープンの代わりに、プロセスごとの上限 (RATE_LIMIT / EXPECTED_WORKERS) で近似する
+    is_allowed, remaining, reset_time = fallback_limiter.check(client_ip)
+    return is_allowed, remaining, reset_time, fallback_limiter.limit, "local_fallback"
 
 
 @app.before_request
@@ -87,29 +298,82 @@ def rate_limit_check():
         return None
 
     client_ip = get_client_ip()
-    is_allowed, remaining, reset_time = check_rate_limit(client_ip)
+    result = decide(client_ip)
+    if result is None:
+        return acquire_concurrency(client_ip)
+    is_allowed, remaining, reset_time, limit, rule_name = result
 
     # レスポンスヘッダを設定するための情報を保存
     request.rate_limit_info = {
-        "limit": RATE_LIMIT,
+        "limit": limit,
         "remaining": remaining,
         "reset": reset_time,
+        "rule": rule_name,
     }
 
     if not is_allowed:
-        response = jsonify(
-            {
-                "error": "Too Many Requests",
-                "message": f"Rate limit exceeded. Try again in {reset_time - int(time.time())} seconds.",
-            }
-        )
+        body = {
+            "error": "Too Many Requests",
+            "message": f"Rate limit exceeded. Try again in {reset_time - int(time.time())} seconds.",
+        }
+        if rule_name:
+            body["rule"] = rule_name
+        response = jsonify(body)
         response.status_code = 429
-        response.headers["X-RateLimit-Limit"] = str(RATE_LIMIT)
+        response.headers["X-RateLimit-Limit"] = str(limit)
         response.headers["X-RateLimit-Remaining"] = "0"
         response.headers["X-RateLimit-Reset"] = str(reset_time)
         response.headers["Retry-After"] = str(reset_time - int(time.time()))
+        if rule_name:
+            response.headers["X-RateLimit-Rule"] = rule_name
         return response
 
+    return acquire_concurrency(client_ip)
+
+
+def acquire_concurrency(client_ip):
+    """同時実行数のスロットを取る。上限に達していれば429を返す"""
+    if concurrency_limiter is None:
+        return None
+    route = request.url_rule.rule if request.url_rule else request.path
+    lease = None
+    try:
+        # セマフォを置くシャードのブレーカーは ConcurrencyLimiter がシャードごとに使う
+        lease = concurrency_limiter.acquire(client_ip, route)
+    except ShardUnavailable:
+        pass
+    except redis.RedisError as e:
+        app.logger.error(f"Redis error: {e}")
+    if lease is None:
+        lease = concurrency_limiter.acquire_local(client_ip, route)
+
+    if lease.granted:
+        # teardown_request で返却する
+        g.concurrency_lease = lease
+        return None
+    response = jsonify(
+        {
+            "error": "Too Many Concurrent Requests",
+            "message": f"Too many in-flight requests per {lease.tripped}. Retry shortly.",
+        }
+    )
+    response.status_code = 429
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.teardown_request
+def release_concurrency(error=None):
+    """リクエストの終了時 (例外時も) に同時実行数のスロットを返却"""
+    lease = g.pop("concurrency_lease", None)
+    if lease is None:
+        return
+    try:
+        concurrency_limiter.release(lease, failed=error is not None)
+    except redis.RedisError as e:
+        # 返却できなかったリースは CONCURRENCY_LEASE_SECONDS 後に期限切れになる
+        app.logger.error(f"Redis error while releasing concurrency lease: {e}")
+
 
 @app.after_request
 def add_rate_limit_headers(response):
@@ -119,6 +383,8 @@ def add_rate_limit_headers(response):
         response.headers["X-RateLimit-Limit"] = str(info["limit"])
         response.headers["X-RateLimit-Remaining"] = str(info["remaining"])
         response.headers["X-RateLimit-Reset"] = str(info["reset"])
+        if info["rule"]:
+            response.headers["X-RateLimit-Rule"] = info["rule"]
     return response
 
 
@@ -126,10 +392,41 @@ def add_rate_limit_headers(response):
 def health_check():
     """ヘルスチェックエンドポイント"""
     try:
-        redis_client.ping()
-        return jsonify({"status": "healthy", "redis": "connected"}), 200
+        for client in shard_router.clients():
+            client.ping()
+        body = {
+            "status": "healthy",
+            "redis": "connected",
+            "limiter_mode": LIMITER_MODE,
+            "shards": shard_router.count,
+        }
+        if hybrid_limiter is not None:
+            body["limiter_stats"] = hybrid_limiter.stats
+        if concurrency_limiter is not None:
+            body["concurrency_stats"] = concurrency_limiter.stats
+        body["breakers"] = breaker_status()
+        return jsonify(body), 200
     except redis.RedisError:
-        return jsonify({"status": "unhealthy", "redis": "disconnected"}), 503
+        return (
+            jsonify(
+                {
+                    "status": "unhealthy",
+                    "redis": "disconnected",
+                    "breakers": breaker_status(),
+                }
+            ),
+            503,
+        )
+
+
+def breaker_status():
+    """シャードごとのブレーカーの状態とフォールバックでの判定数"""
+    return {
+        "shards": {
+            name: {"state": b.state, **b.stats} for name, b in breakers.items()
+        },
+        "fallback_decisions": fallback_limiter.stats["decisions"],
+    }
 
 
 @app.route("/api/test", methods=["GET"])
@@ -149,17 +446,26 @@ def test_endpoint():
 def reset_rate_limit():
     """レート制限をリセット（テスト用）"""
     client_ip = get_client_ip()
-    base_key = f"rate_limit:{client_ip}"
+    shard = shard_router.shard_for(client_ip)
+    base_key = shard.key(client_ip)
     pattern = f"{base_key}:*"
 
     try:
-        keys_to_delete = set(redis_client.keys(pattern))
-        keys_to_delete.add(base_key)
+        if hybrid_limiter is not None:
+            hybrid_limiter.reset(client_ip)
+        # シャードごとに削除するキーを集める
+        keys_by_shard = {shard: set(shard.client.keys(pattern)) | {base_key}}
+        if rule_engine is not None:
+            for rule_shard, rule_pattern in rule_engine.client_key_patterns(client_ip):
+                keys_by_shard.setdefault(rule_shard, set()).update(
+                    rule_shard.client.keys(rule_pattern)
+                )
 
         # Redis.delete は存在しないキーを無視しつつ削除数を返す
         deleted_count = 0
-        if keys_to_delete:
-            deleted_count = redis_client.delete(*keys_to_delete)
+        for key_shard, keys_to_delete in keys_by_shard.items():
+            if keys_to_delete:
+                deleted_count += key_shard.client.delete(*keys_to_delete)
 
         if deleted_count:
             return (
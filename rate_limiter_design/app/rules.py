@@ -0,0 +1,208 @@
+import json
+import re
+from fnmatch import translate
+
+import redis
+
+from fallback import call_with_breaker
+
+# ルールでキーにできる次元 (リクエストから取り出す値)
+DIMENSIONS = ("ip", "api_key", "route", "method")
+
+# 1つのシャードに置かれたルールをまとめて1回のEVALSHAで判定・加算する (スライディングウィンドウカウンタ)
+# KEYS[i]  : ルールiのハッシュ {ウィンドウ番号: 件数}
+# ARGV     : limit_1, window_ms_1, limit_2, window_ms_2, ...
+# 戻り値   : {超過したルール番号 (0なら許可), 残りが最も少ないルール番号, その残り, そのリセットまでのミリ秒,
+#             加算したウィンドウ番号_1, 加算したウィンドウ番号_2, ...}
+# どれか1つでも超過する場合はどのカウンタも増やさない
+RULES_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local windows = {}
+local tightest, tightest_remaining, tightest_reset = 0, -1, 0
+for i = 1, #KEYS do
+    local limit = tonumber(ARGV[i * 2 - 1])
+    local window = tonumber(ARGV[i * 2])
+    local current = math.floor(now / window)
+    local counts = redis.call('HMGET', KEYS[i], current, current - 1)
+    local elapsed = (now % window) / window
+    local estimate = (tonumber(counts[2]) or 0) * (1 - elapsed) + (tonumber(counts[1]) or 0)
+    local reset = window - (now % window)
+    if estimate + 1 > limit then
+        return {i, i, 0, reset}
+    end
+    local remaining = math.floor(limit - estimate - 1)
+    if tightest == 0 or remaining < tightest_remaining then
+        tightest, tightest_remaining, tightest_reset = i, remaining, reset
+    end
+    windows[i] = current
+end
+for i = 1, #KEYS do
+    local window = tonumber(ARGV[i * 2])
+    redis.call('HINCRBY', KEYS[i], windows[i], 1)
+    redis.call('HDEL', KEYS[i], windows[i] - 2)
+    redis.call('PEXPIRE', KEYS[i], window * 2)
+end
+local result = {0, tightest, tightest_remaining, tightest_reset}
+for i = 1, #KEYS do
+    result[4 + i] = windows[i]
+end
+return result
+"""
+
+
+class Rule:
+    """One compiled rate-limit rule: which requests it applies to and how they are keyed."""
+
+    def __init__(self, name, by, limit, window, paths=None, methods=None):
+        unknown = [d for d in by if d not in DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Rule {name!r}: unknown dimension(s) {unknown}")
+        if limit <= 0 or window <= 0:
+            raise ValueError(f"Rule {name!r}: limit and window must be positive")
+        self.name = name
+        # キーの並びを固定し、ipを先頭にする (リセット時にパターンで探せるように)
+        self.by = tuple(sorted(by, key=lambda d: DIMENSIONS.index(d)))
+        self.limit = limit
+        self.window = window
+        # パスはglob (例: /api/*) をまとめて1つの正規表現にしておく
+        self._path_re = re.compile("|".join(translate(p) for p in paths)) if paths else None
+        self._methods = {m.upper() for m in methods} if methods else None
+
+    def applies_to(self, ctx):
+        if self._methods is not None and ctx["method"] not in self._methods:
+            return False
+        if self._path_re is not None and not self._path_re.match(ctx["path"]):
+            return False
+        # 次元の値がないリクエスト (例: APIキーなし) にはこのルールを適用しない
+        return all(ctx.get(d) for d in self.by)
+
+    def key_suffix(self, ctx):
+        parts = "".join(f":{d}={ctx[d]}" for d in self.by)
+        return f"rule:{self.name}{parts}"
+
+
+class RuleDecision:
+    def __init__(self, allowed, rule, remaining, reset_time):
+        self.allowed = allowed
+        # 超過したルール (許可時は残りが最も少ないルール)。適用ルールがなければNone
+        self.rule = rule
+        self.remaining = remaining
+        self.reset_time = reset_time
+
+
+def load_rules(config):
+    """Compile a list of rule dicts (or a JSON string) into Rule objects."""
+    if isinstance(config, str):
+        config = json.loads(config)
+    rules = []
+    names = set()
+    for entry in config:
+        name = entry["name"]
+        if name in names:
+            raise ValueError(f"Duplicate rule name {name!r}")
+        names.add(name)
+        match = entry.get("match", {})
+        rules.append(
+            Rule(
+                name,
+                entry.get("by", []),
+                int(entry["limit"]),
+                int(entry["window"]),
+                paths=match.get("paths"),
+                methods=match.get("methods"),
+            )
+        )
+    return rules
+
+
+class RuleEngine:
+    """
+    Evaluates every applicable rule for a request, one EVALSHA per shard involved.
+
+    Rules keyed by the shard_by dimension (the client IP by default) live on
+    the shard of that value, so the common case is a single round trip.
+    Every other rule (per API key, per route, global, ...) keeps its full
+    limit and lives on the shard hashed from its own counter key, costing one
+    more script call per extra shard. Each call goes through that shard's
+    circuit breaker. If a later shard rejects the request or fails (including
+    an open breaker, raised as ShardUnavailable), the counters already
+    incremented on earlier shards are rolled back.
+    """
+
+    def __init__(self, router, rules, shard_by="ip", breakers=None):
+        if shard_by not in DIMENSIONS:
+            raise ValueError(f"Unknown shard dimension {shard_by!r}")
+        self.router = router
+        self.rules = rules
+        self.shard_by = shard_by
+        # シャード名 -> CircuitBreaker
+        self.breakers = breakers or {}
+        self._script = router.shards[0].client.register_script(RULES_SCRIPT)
+
+    def _shard_for(self, rule, ctx):
+        if self.shard_by in rule.by:
+            return self.router.shard_for(ctx[self.shard_by])
+        return self.router.shard_for(rule.key_suffix(ctx))
+
+    def check(self, ctx, now):
+        matched = [r for r in self.rules if r.applies_to(ctx)]
+        if not matched:
+            return RuleDecision(True, None, None, None)
+        # シャードごとにまとめる (クライアントのシャードを先頭に)
+        groups = {self.router.shard_for(ctx.get(self.shard_by) or ""): []}
+        for r in matched:
+            groups.setdefault(self._shard_for(r, ctx), []).append(r)
+
+        applied = []
+        tightest = None
+        try:
+            for shard, rules in groups.items():
+                if not rules:
+                    continue
+                keys = [shard.key(r.key_suffix(ctx)) for r in rules]
+                args = []
+                for r in rules:
+                    args += [r.limit, r.window * 1000]
+                result = call_with_breaker(
+                    self.breakers.get(shard.name),
+                    shard,
+                    self._script,
+                    keys=keys,
+                    args=args,
+                    client=shard.client,
+                )
+                tripped, index, remaining, reset_ms = result[:4]
+                if tripped:
+                    self._rollback(applied)
+                    return RuleDecision(False, rules[tripped - 1], 0, int(now + reset_ms / 1000 + 0.999))
+                applied.append((shard, keys, result[4:]))
+                if tightest is None or remaining < tightest[1]:
+                    tightest = (rules[index - 1], remaining, reset_ms)
+        except Exception:
+            # 途中のシャードが失敗したら、判定できなかったリクエストの加算を残さない
+            self._rollback(applied)
+            raise
+        rule, remaining, reset_ms = tightest
+        return RuleDecision(True, rule, remaining, int(now + reset_ms / 1000 + 0.999))
+
+    def _rollback(self, applied):
+        """Undo the increments already made on other shards for a rejected or failed request."""
+        for shard, keys, windows in applied:
+            try:
+                with shard.client.pipeline() as pipe:
+                    for key, window in zip(keys, windows):
+                        pipe.hincrby(key, window, -1)
+                    pipe.execute()
+            except redis.RedisError:
+                # 戻せなかった分は多めに数えるだけで、ウィンドウが進めば消える
+                breaker = self.breakers.get(shard.name)
+                if breaker is not None:
+                    breaker.record_failure()
+
+    def client_key_patterns(self, client_ip):
+        """(shard, key patterns) of every rule keyed by this client IP (for /api/reset)."""
+        shard = self.router.shard_for(client_ip) if self.shard_by == "ip" else None
+        patterns = [f"rule:*:ip={client_ip}", f"rule:*:ip={client_ip}:*"]
+        shards = [shard] if shard is not None else self.router.shards
+        return [(s, s.key(p)) for s in shards for p in patterns]
@@ -0,0 +1,81 @@
+import hashlib
+from bisect import bisect
+
+import redis
+
+# 1シャードあたりのリング上の仮想ノード数 (多いほど偏りが小さい)
+RING_REPLICAS = 100
+
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class Shard:
+    """Where one group of clients keeps all of its limiter keys."""
+
+    def __init__(self, name, client, tag=None):
+        self.name = name
+        self.client = client
+        # Redis Clusterではハッシュタグ {tag} で同じシャードのキーを同じスロットに置く
+        self.tag = tag
+
+    def key(self, suffix):
+        if self.tag is None:
+            return f"rate_limit:{suffix}"
+        return f"rate_limit:{{{self.tag}}}:{suffix}"
+
+
+class ShardRouter:
+    """
+    クライアントIDからシャードを選ぶコンシステントハッシュリング
+
+    1クライアントのキー (スライディングログ、hybridの予約数、ルールのカウンタ) は全て同じシャードに置くので、
+    複数キーを触るLuaスクリプトやパイプラインも1つのシャードで完結する。
+    シャードを追加・削除しても、移動するのはリング上で隣接する一部のクライアントだけ。
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self._ring = sorted(
+            (_ring_hash(f"{shard.name}#{i}"), shard)
+            for shard in shards
+            for i in range(RING_REPLICAS)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    @property
+    def count(self):
+        return len(self.shards)
+
+    def shard_for(self, client_id):
+        i = bisect(self._points, _ring_hash(client_id)) % len(self._ring)
+        return self._ring[i][1]
+
+    def clients(self):
+        """Distinct Redis clients behind the shards."""
+        seen = {}
+        for shard in self.shards:
+            seen.setdefault(id(shard.client), shard.client)
+        return list(seen.values())
+
+    @classmethod
+    def single(cls, client):
+        # 単一ノードではキー名を従来どおりにする
+        return cls([Shard("default", client)])
+
+    @classmethod
+    def from_nodes(cls, nodes, **kwargs):
+        """Standalone Redis nodes given as "host:port,host:port,..."; each node is one shard."""
+        shards = []
+        for node in nodes.split(","):
+            host, port = node.strip().rsplit(":", 1)
+            client = redis.Redis(host=host, port=int(port), decode_responses=True, **kwargs)
+            shards.append(Shard(node.strip(), client))
+        return cls(shards)
+
+    @classmethod
+    def for_cluster(cls, host, port, virtual_shards=16, **kwargs):
+        """Redis Cluster: clients are spread over virtual shards, each pinned to a hash-tag slot."""
+        client = redis.RedisCluster(host=host, port=port, decode_responses=True, **kwargs)
+        return cls([Shard(f"s{i}", client, tag=f"rl{i}") for i in range(virtual_shards)])